@@ -1,16 +1,30 @@
-from pydub import AudioSegment
 import subprocess
+import shutil
 import os
-import math
-from config_utils import get_config, get_voice_data
+from config_utils import get_config, get_voice_catalog
+from loudness_utils import analyze_audio
+from voice_utils import select_voice
 
 config = get_config()
+# Length of the music under the narration, and of its fade out (seconds)
+MUSIC_CLIP_LENGTH = 30
+MUSIC_FADE_DURATION = 2
+# Intermediate audio is kept as PCM, and only the final mix is encoded
+INTERMEDIATE_AUDIO_CODEC = 'pcm_s16le'
+FINAL_AUDIO_BITRATE = config.get('audio-bitrate', '192k')
+# Bump when the way music renditions are made or measured changes, so that they are all rebuilt
+RENDITION_VERSION = 2
+# How loud the music is mixed under the narration, relative to the narration's RMS loudness
+MUSIC_VOICE_RATIO = config.get('music-voice-ratio', 0.35)
+# Peak level the final mix is limited to, as a linear amplitude (0.89 is about -1 dBFS)
+MIX_PEAK_LIMIT = 0.89
 
 
 # Used when the voice catalog is maintained by the Sunfire team
 def find_voice(client, tone, topic):
     """
-    Finds a voice based on the provided tone and topic.
+    Finds a voice based on the provided tone and topic.  The voices are ranked locally; the client is only used to
+    break ties when the 'voice-tiebreaker' option is 'llm'.
 
     Args:
         client (object): The client object.
@@ -21,12 +35,11 @@ def find_voice(client, tone, topic):
         dict: A dictionary containing the voice information.
 
     Raises:
-        None.
+        ValueError: If the voice catalog is empty.
     """
-    voices = get_voice_data(config['voice-data'])
-    from text_to_text import get_matching_voice
+    catalog = get_voice_catalog(config['voice-data'])
 
-    voice = get_matching_voice(client, tone, voices, topic)
+    voice = select_voice(client, tone, topic, catalog['voices'], catalog['index'])
 
     voice_info = {
         "voice_id": voice['id'],
@@ -42,160 +55,102 @@ def find_voice(client, tone, topic):
 def fit_clip_length(clip, local_dir, desired_duration):
     """
     Fits the length of the audio clip to the desired duration by adjusting the speed factor and padding with silence if needed.
+    Both are done in a single ffmpeg pass.
 
     Args:
-        clip (dict): The clip information.
+        clip (dict): The clip information.  Its 'duration' is probed from the file if it isn't known.
         local_dir (str): The directory where the audio clip is located.
         desired_duration (float): The desired duration of the audio clip.
 
     Returns:
         dict: The updated clip information.
     """
-    audio = AudioSegment.from_file(local_dir+clip['filename'])
-
-    current_duration = len(audio) / 1000.0  # In seconds
+    current_duration = clip.get('duration') or probe_duration(local_dir+clip['filename'])  # In seconds
     speed_factor = current_duration / desired_duration
     # Limit the speed_factor to be between 0.85 and 1.2
     speed_factor = max(0.85, min(speed_factor, 1.2))
     print("Speed Factor: " + str(speed_factor))
     input_file = clip['filename']
-    output_file = f"adjusted_{input_file}"
-    # Construct the ffmpeg command
+    # The result is only an intermediate for the mix, so it is kept as PCM rather than encoded again
+    output_file = f"adjusted_{os.path.splitext(input_file)[0]}.wav"
+    # Due to limits we have set, the length might be too short.  If so, pad it with silence up to the desired
+    # duration.  Speech is never cut, so it can also end up longer.
     cmd = ["ffmpeg", "-y", "-i",
            local_dir + input_file,
-           "-filter:a", f"atempo={speed_factor}",
+           "-filter:a", f"atempo={speed_factor},apad=whole_dur={desired_duration}",
+           "-c:a", INTERMEDIATE_AUDIO_CODEC,
            local_dir + output_file]
 
     # Execute the command
     subprocess.run(cmd, check=True)
 
-    # Due to limits we have set, the length might be too short.  If so, pad
-    # it with silence
-    audio = AudioSegment.from_file(local_dir+output_file)
-    current_duration = len(audio) / 1000.0  # In seconds
-    if current_duration < desired_duration:
-        padding = desired_duration - current_duration
-        if padding > 0.1:  # If it's less than 0.1 seconds, don't bother
-            audio = audio.append(AudioSegment.silent(duration=padding*1000))
-            audio.export(local_dir+output_file, format="mp3")
-
     clip['filename'] = output_file
+    clip['duration'] = max(current_duration / speed_factor, desired_duration)
     return clip
 
 
-# This is intended to be used with the music.  It just cuts the end off.
-def trim_clip(clip, local_dir):
+def link_file(source, destination):
     """
-    Trims the audio clip to the target length if it's long enough.
+    Hard links a file, or copies it when it can't be linked (e.g. across file systems).
 
     Args:
-        clip (dict): The clip information.
-        local_dir (str): The directory where the audio clip is located.
-
-    Returns:
-        dict: The updated clip information after trimming.
-
-    Raises:
-        ValueError: If the audio clip is shorter than the target length.
+        source (str): The path to the file.
+        destination (str): The path of the link.
     """
-    clip_length = 30 * 1000  # in ms
-    audio = AudioSegment.from_file(local_dir+clip['filename'])
-
-    # Trim the audio to the target length if it's long enough
-    if len(audio) > clip_length:
-
-        trimmed_audio = audio[:clip_length]
-        filename = "trimmed_"+clip['filename']
-        # Export the trimmed audio file
-        trimmed_audio.export(local_dir+filename, format="mp3")
-        clip['filename'] = filename
-        return clip
-    else:
-        raise ValueError("Audio is shorter than the target length.")
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy(source, destination)
 
 
-# Intended for use with the music
-def fade_out_audio(clip, local_dir):
+def probe_duration(path):
     """
-    Fades out the audio clip provided in the 'clip' dictionary using the specified fade duration.
+    Reads the duration of an audio file from its headers, without decoding it.
 
     Args:
-        clip (dict): Dictionary containing information about the audio clip.
-        local_dir (str): The directory path where the audio clip is located.
+        path (str): The path to the audio file.
 
     Returns:
-        dict: The updated clip information after applying the fade out effect.
-    """
-    fade_duration = 2000
-    audio = AudioSegment.from_file(local_dir+clip['filename'])
-
-    # Apply a fade out over the last `fade_duration` milliseconds
-    faded_audio = audio.fade_out(fade_duration)
-    filename = "faded_"+clip['filename']
-    # Export the modified audio file
-    faded_audio.export(local_dir+filename, format="mp3")
-    clip['filename'] = filename
-    return clip
-
-
-# Intended for use with the music
-def trim_and_fade(local_dir, clip):
-    """
-    Trims and fades out an audio clip.
-
-    Args:
-        local_dir (str): The directory path where the audio clip is located.
-        clip (dict): A dictionary containing information about the audio clip.
+        float: The duration in seconds.
 
-    Returns:
-        dict: The updated clip information after applying the trim and fade out effects.
+    Raises:
+        subprocess.CalledProcessError: If the ffprobe command fails to execute successfully.
     """
-    trimmed_clip = trim_clip(clip, local_dir)
-    faded_clip = fade_out_audio(trimmed_clip, local_dir)
-    return faded_clip
+    cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path]
+    result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+    return float(result.stdout.strip())
 
 
-def modify_volume(clip, factor, local_dir):
+# Used to build the music library renditions ahead of time
+def render_music_clip(source_path, output_path):
     """
-    Modifies the volume of an audio clip.
+    Trims and fades out a piece of music in a single ffmpeg pass, like `combine_audio_clips` does for music that
+    wasn't prepared ahead of time.
 
     Args:
-        clip (dict): A dictionary containing information about the audio clip.
-        factor (float): The factor by which to adjust the volume. A value greater than 1 increases the volume, while a value less than 1 decreases the volume.
-        local_dir (str): The directory path where the audio clip is located.
-
-    Returns:
-        dict: The updated clip information after applying the volume adjustment.
+        source_path (str): The path to the music.
+        output_path (str): The path to save the rendition to.
 
     Raises:
+        ValueError: If the music is shorter than the target length.
         subprocess.CalledProcessError: If the ffmpeg command fails to execute successfully.
-
-    Notes:
-        - The function uses the ffmpeg command-line tool to modify the volume of the audio clip.
-        - The new audio clip is saved with the filename 'volume_change_{original_filename}'.
-        - If the new audio clip is successfully created, the 'filename' key in the clip dictionary is updated to the new filename.
-        - If the new audio clip fails to be created, a message is printed to indicate the failure.
     """
-    new_file = f'volume_change_{clip['filename']}'
-    # Construct the ffmpeg com0and
-    cmd = ["ffmpeg", "-y",
-           "-i", local_dir + clip['filename'],
-           "-filter:a",
-           f"volume={factor}",
-           local_dir+new_file]
-    # Execute the command
+    if probe_duration(source_path) <= MUSIC_CLIP_LENGTH:
+        raise ValueError("Audio is shorter than the target length.")
+    cmd = ["ffmpeg", "-y", "-i", source_path,
+           "-t", str(MUSIC_CLIP_LENGTH),
+           "-af", f"afade=t=out:st={MUSIC_CLIP_LENGTH - MUSIC_FADE_DURATION}:d={MUSIC_FADE_DURATION}",
+           output_path]
     subprocess.run(cmd, check=True)
-    if os.path.isfile(local_dir+new_file):
-        clip['filename'] = new_file
-    else:
-        print("Volume Adjustment FAILED")
-    return clip
 
 
 def combine_audio_clips(audio_data):
     """
-    Combines two audio clips, adjusts the loudness of the music clip based on the voice clip's loudness, and returns
-    information about the combined audio file.
+    Combines two audio clips in a single ffmpeg pass: the music is trimmed and faded out (unless it was prepared
+    ahead of time), its loudness is brought to the configured ratio of the voice clip's loudness, and it is mixed
+    under the voice.  The mix is encoded to AAC, ready to be muxed with the video as is.
 
     Args:
         audio_data (dict): A dictionary containing information about the audio clips, including local directory,
@@ -206,49 +161,52 @@ def combine_audio_clips(audio_data):
 
     Raises:
         FileNotFoundError: If one or both audio clips are missing.
+        subprocess.CalledProcessError: If the ffmpeg command fails to execute successfully.
     """
     save_dir = audio_data['local_dir']
-    narration_clip = AudioSegment.from_file(save_dir+audio_data['clips']['voice']['filename'])
-    music_clip = AudioSegment.from_file(save_dir+audio_data['clips']['music']['filename'])
-
-    # Check and adjust loudness
-    if narration_clip and music_clip:
-        print("Checking Loudness")
-        # Measure the loudness of each clip
-        narration_rms = narration_clip.rms
-        music_rms = music_clip.rms
-
-        print("Narration RMS:", narration_rms)
-        print("Music RMS:", music_rms)
-
-        # Calculate the desired RMS for the music based on the desired_ratio
-        desired_music_rms = narration_rms * 0.35  # 0.35 = 35% as loud as the voice
-
-        # Calculate the required change in volume in dB
-        change_in_volume_db = 20 * math.log10(desired_music_rms / music_rms) if music_rms != 0 else 0
-        # Adjust the music clip's volume
-        adjusted_music_clip = music_clip + change_in_volume_db
-        volume_factor = (adjusted_music_clip.rms / music_rms)
-        print("Changing Music Volume by factor: ", str(volume_factor))
-        volume_adjusted_clip = modify_volume(audio_data['clips']['music'], volume_factor, save_dir)
-        # Construct the ffmpeg command
-
-        output_filename = "combined_audio.mp3"
-        cmd = ["ffmpeg", "-y", "-i",
-               save_dir+audio_data['clips']['voice']['filename'],
-               "-i", save_dir + volume_adjusted_clip['filename'],
-               "-filter_complex", "amerge=inputs=2", save_dir + output_filename]
-        # Execute the command
-        subprocess.run(cmd, check=True)
-        if os.path.isfile(save_dir + output_filename):
-            file_name = output_filename
-        else:
-            print("Volume Adjustment FAILED")
-
-        # Return information about the new file
-        return {"filename": file_name, "type": "combined"}
-
-    else:
+    voice = audio_data['clips']['voice']
+    music = audio_data['clips']['music']
+    if not (os.path.isfile(save_dir + voice['filename']) and os.path.isfile(save_dir + music['filename'])):
         # If one of the clips is missing, handle the error appropriately
         print("Weird: Couldn't find both clips.")
         raise FileNotFoundError("One or both audio clips could not be found.")
+
+    print("Checking Loudness")
+    # Measure the loudness of each clip.  Music from the prepared library comes with its loudness already measured;
+    # other music is measured over the part that ends up in the mix, not the whole song.
+    narration_rms = analyze_audio(save_dir + voice['filename'])['rms']
+    if 'rms' in music:
+        music_rms = music['rms']
+    else:
+        music_rms = analyze_audio(save_dir + music['filename'],
+                                  None if music.get('prepared') else MUSIC_CLIP_LENGTH)['rms']
+    print("Narration RMS:", narration_rms)
+    print("Music RMS:", music_rms)
+
+    # Scale the music to the desired ratio of the voice's loudness (e.g. 0.35 = 35% as loud as the voice)
+    volume_factor = narration_rms * MUSIC_VOICE_RATIO / music_rms if music_rms != 0 else 1
+    print("Changing Music Volume by factor: ", str(volume_factor))
+    music_filters = [f"volume={volume_factor}"]
+    if not music.get('prepared'):
+        music_filters = [f"atrim=duration={MUSIC_CLIP_LENGTH}",
+                         f"afade=t=out:st={MUSIC_CLIP_LENGTH - MUSIC_FADE_DURATION}:d={MUSIC_FADE_DURATION}"
+                         ] + music_filters
+    # The mix lasts as long as the voice, and isn't normalized so that the voice keeps its level.  It is stereo: a
+    # mono voice is centered, and stereo music keeps its width.  Since the clips are summed at full level, a limiter
+    # keeps the peaks under MIX_PEAK_LIMIT instead of letting them clip in the AAC encode.
+    graph = ("[0:a]aformat=channel_layouts=stereo[voice];"
+             f"[1:a]aformat=channel_layouts=stereo,{','.join(music_filters)}[music];"
+             f"[voice][music]amix=inputs=2:duration=first:normalize=0,alimiter=limit={MIX_PEAK_LIMIT}:level=0[mix]")
+
+    # This is the only lossy encode of the narration, straight to the codec the video is muxed with
+    output_filename = "combined_audio.m4a"
+    cmd = ["ffmpeg", "-y",
+           "-i", save_dir + voice['filename'],
+           "-i", save_dir + music['filename'],
+           "-filter_complex", graph, "-map", "[mix]",
+           "-c:a", "aac", "-b:a", FINAL_AUDIO_BITRATE,
+           save_dir + output_filename]
+    subprocess.run(cmd, check=True)
+
+    # Return information about the new file
+    return {"filename": output_filename, "type": "combined"}
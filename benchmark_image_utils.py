@@ -0,0 +1,148 @@
+import argparse
+import multiprocessing
+import time
+from io import BytesIO
+from PIL import Image, ImageChops, ImageStat
+from image_utils import prepare_image, open_image, get_platform_specs
+
+# Compares the 'fast' and 'exact' blurred background modes of image_utils.prepare_image.
+# Usage: python benchmark_image_utils.py [image ...] [--platform youtube] [--repeat 5]
+# Without images, a synthetic portrait photo is used, which gets wide blurred borders on landscape platforms.
+# With --decode, compares decoding JPEGs at full size with the reduced (draft) decode of image_utils.open_image
+# instead, in wall time and peak RSS.  Without images, a synthetic 48 MP JPEG is used.
+
+
+def make_test_image(width=3024, height=4032):
+    """
+    Creates a synthetic, photo-like test image with smooth gradients and noise.
+
+    Args:
+        width (int): The width of the image.
+        height (int): The height of the image.
+
+    Returns:
+        PIL.Image.Image: The test image.
+    """
+    red = Image.linear_gradient('L').resize((width, height))
+    green = Image.radial_gradient('L').resize((width, height))
+    blue = Image.effect_noise((width, height), 48)
+    return Image.merge('RGB', (red, green, blue))
+
+
+def time_mode(image, width, height, mode, repeat):
+    """
+    Times `prepare_image` in the given background mode.
+
+    Args:
+        image (PIL.Image.Image): The source image.
+        width (int): The output width.
+        height (int): The output height.
+        mode (str): The background mode.
+        repeat (int): How many times to run it.
+
+    Returns:
+        tuple: The best time in seconds and the prepared image.
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = prepare_image(image.copy(), width, height, '#000000', mode)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def get_peak_rss():
+    """
+    Returns the peak RSS of this process in MB.  It is read from /proc (Linux only) because, unlike ru_maxrss, it
+    doesn't carry over the parent's peak into spawned processes.
+    """
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return float('nan')
+
+
+def prepare_encoded(data, width, height, reduced):
+    """
+    Decodes and prepares an encoded image, in a fresh process so that its peak RSS only counts this image.
+
+    Args:
+        data (bytes): The content of the image file.
+        width (int): The output width.
+        height (int): The output height.
+        reduced (bool): Whether to decode through `open_image`, or at full size.
+
+    Returns:
+        tuple: The time in seconds, the peak RSS in MB and the prepared image as raw RGB bytes.
+    """
+    start = time.perf_counter()
+    image = open_image(BytesIO(data), width, height) if reduced else Image.open(BytesIO(data))
+    result = prepare_image(image, width, height, '#000000')
+    elapsed = time.perf_counter() - start
+    return elapsed, get_peak_rss(), result.tobytes()
+
+
+def compare_decodes(name, data, width, height, repeat):
+    """
+    Prints the time and peak RSS of preparing an image decoded at full size and at reduced size.
+
+    Args:
+        name (str): The name of the image, for the report.
+        data (bytes): The content of the image file.
+        width (int): The output width.
+        height (int): The output height.
+        repeat (int): How many times to run each decode; the best time and lowest peak are reported.
+    """
+    runs = {}
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        for reduced in (False, True):
+            results = [pool.apply(prepare_encoded, (data, width, height, reduced)) for _ in range(repeat)]
+            runs[reduced] = (min(run[0] for run in results), min(run[1] for run in results), results[0][2])
+    full = Image.frombytes('RGB', (width, height), runs[False][2])
+    difference = ImageChops.difference(full, Image.frombytes('RGB', (width, height), runs[True][2]))
+    mean_difference = sum(ImageStat.Stat(difference).mean) / 3
+    print(f"{name} -> {width}x{height}: full decode {runs[False][0]:.2f} s, {runs[False][1]:.0f} MB peak RSS; "
+          f"reduced decode {runs[True][0]:.2f} s, {runs[True][1]:.0f} MB peak RSS; "
+          f"mean pixel difference {mean_difference:.2f}/255")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the blurred background modes of prepare_image")
+    parser.add_argument('images', nargs='*', help="Images to prepare (a synthetic image is used if none are given)")
+    parser.add_argument('--platform', default='youtube', help="Platform to prepare the images for")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per mode; the best time is reported")
+    parser.add_argument('--decode', action='store_true', help="Compare full and reduced JPEG decoding instead")
+    args = parser.parse_args()
+
+    width, height, _ = get_platform_specs(args.platform)
+    if args.decode:
+        if args.images:
+            sources = []
+            for path in args.images:
+                with open(path, 'rb') as file:
+                    sources.append((path, file.read()))
+        else:
+            output = BytesIO()
+            make_test_image(8000, 6000).save(output, format='JPEG', quality=90)
+            sources = [('synthetic 48 MP JPEG', output.getvalue())]
+        for name, data in sources:
+            compare_decodes(name, data, width, height, args.repeat)
+        return
+    sources = [(path, Image.open(path)) for path in args.images] or [('synthetic', make_test_image())]
+    for name, image in sources:
+        image.load()
+        exact_time, exact = time_mode(image, width, height, 'exact', args.repeat)
+        fast_time, fast = time_mode(image, width, height, 'fast', args.repeat)
+        difference = ImageChops.difference(exact, fast)
+        mean_difference = sum(ImageStat.Stat(difference).mean) / 3
+        max_difference = max(high for _, high in difference.getextrema())
+        print(f"{name} -> {width}x{height}: exact {exact_time * 1000:.1f} ms, fast {fast_time * 1000:.1f} ms "
+              f"({exact_time / fast_time:.1f}x), mean pixel difference {mean_difference:.2f}/255, "
+              f"max {max_difference}/255")
+
+
+if __name__ == '__main__':
+    main()
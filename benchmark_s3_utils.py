@@ -0,0 +1,61 @@
+import argparse
+import os
+import time
+from s3_utils import get_s3_client, upload_batch_to_s3
+
+# Compares sequential and concurrent batch uploads with s3_utils.upload_batch_to_s3.
+# Point it at a local S3 stand-in so it can run without AWS, for example a moto server:
+#   moto_server -p 5000 &
+#   AWS_ACCESS_KEY_ID=test AWS_SECRET_ACCESS_KEY=test AWS_DEFAULT_REGION=us-east-1 \
+#       python benchmark_s3_utils.py --endpoint-url http://127.0.0.1:5000
+
+
+def run(s3, uploads, max_workers):
+    """
+    Uploads a batch and reports the wall time and the per-object timings.
+
+    Args:
+        s3: An S3 client object.
+        uploads (list): The objects to upload.
+        max_workers (int): The maximum number of objects uploaded at the same time.
+
+    Returns:
+        float: The wall time in seconds.
+    """
+    start = time.perf_counter()
+    timings = upload_batch_to_s3(s3, uploads, max_workers=max_workers)
+    elapsed = time.perf_counter() - start
+    slowest = max(timings, key=lambda timing: timing['seconds'])
+    print(f"{max_workers} worker(s): {len(timings)} objects in {elapsed:.2f}s, "
+          f"slowest {slowest['key']} {slowest['seconds']:.2f}s, "
+          f"retries {sum(timing['attempts'] - 1 for timing in timings)}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batch uploads to S3")
+    parser.add_argument('--endpoint-url', help="S3 endpoint, e.g. a local moto server or MinIO")
+    parser.add_argument('--bucket', default='sunfire-benchmark', help="Bucket to upload to (created if missing)")
+    parser.add_argument('--count', type=int, default=12, help="Number of objects per batch")
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024, help="Size of each object in bytes")
+    parser.add_argument('--workers', type=int, default=8, help="Concurrent uploads in the concurrent run")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Round-trip delay added to every request, since a local stand-in has none (seconds)")
+    args = parser.parse_args()
+
+    s3 = get_s3_client(args.endpoint_url)
+    if args.latency:
+        s3.meta.events.register('before-send.s3.*', lambda **kwargs: time.sleep(args.latency))
+    try:
+        s3.create_bucket(Bucket=args.bucket)
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    uploads = [{'bucket': args.bucket, 'key': f'benchmark/object-{i}', 'data': os.urandom(args.size)}
+               for i in range(args.count)]
+    sequential = run(s3, uploads, 1)
+    concurrent = run(s3, uploads, args.workers)
+    print(f"Speed-up: {sequential / concurrent:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
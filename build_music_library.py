@@ -0,0 +1,68 @@
+import argparse
+import os
+import yaml
+from audio_utils import render_music_clip, RENDITION_VERSION
+from loudness_utils import analyze_audio
+from config_utils import get_config, get_music_data
+
+# Renders the music library ahead of time: every song of music-data.yaml is trimmed and faded out like a job would
+# do it, and its loudness is measured.  The renditions go in a 'rendered' directory of the library and their details
+# in the music-renditions file, next to music-data.yaml.  Jobs then only have to link the rendition.
+# Usage: python build_music_library.py [--force]
+# Songs whose source hasn't changed since the last build are skipped, unless --force is given.
+
+
+def build_rendition(song_library, song, previous, force):
+    """
+    Renders and measures one song, unless its existing rendition is still up to date.
+
+    Args:
+        song_library (str): The directory of the music library.
+        song (dict): The song, from the music data.
+        previous (dict): The details of the existing rendition, if any.
+        force (bool): Whether to render the song even if its rendition is up to date.
+
+    Returns:
+        dict: The details of the rendition: its 'File' (relative to the library), the source's 'Source Mtime', and
+        the 'Duration', 'RMS', 'dBFS', 'Peak dBFS' and 'LUFS' of the rendition.
+    """
+    source_path = song_library + song['File']
+    source_mtime = os.stat(source_path).st_mtime_ns
+    rendition = f"rendered/{song['File']}"
+    if (not force and previous and previous.get('Version') == RENDITION_VERSION
+            and previous.get('Source Mtime') == source_mtime and os.path.exists(song_library + rendition)):
+        return previous
+    render_music_clip(source_path, song_library + rendition)
+    loudness = analyze_audio(song_library + rendition)
+    return {'File': rendition, 'Version': RENDITION_VERSION, 'Source Mtime': source_mtime,
+            'Duration': loudness['duration'], 'RMS': loudness['rms'], 'dBFS': round(loudness['rms_dbfs'], 2),
+            'Peak dBFS': round(loudness['peak_dbfs'], 2), 'LUFS': round(loudness['lufs'], 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-render the trimmed and faded music library")
+    parser.add_argument('--force', action='store_true', help="Render every song, even those that are up to date")
+    args = parser.parse_args()
+
+    config = get_config()
+    music_data = get_music_data(config['music-data'])
+    renditions_path = config.get('music-renditions', 'config/music-renditions.yaml')
+    previous = (get_music_data(renditions_path) or {}) if os.path.exists(renditions_path) else {}
+    song_library = music_data['Data Directory']
+    os.makedirs(song_library + 'rendered', exist_ok=True)
+
+    renditions = {}
+    for song in music_data['Songs']:
+        try:
+            renditions[song['File']] = build_rendition(song_library, song, previous.get(song['File']), args.force)
+            print(f"{song['File']}: {renditions[song['File']]['LUFS']} LUFS")
+        except Exception as e:
+            print(f"Skipping {song['File']}: {e}")
+
+    with open(renditions_path, 'w') as file:
+        yaml.safe_dump(renditions, file, sort_keys=True)
+    print(f"Wrote {len(renditions)} renditions to {renditions_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import sqlite3
+import time
+from config_utils import get_config
+
+config = get_config()
+# Cached results live in a SQLite file so that they survive restarts and are shared by every worker process.
+CACHE_STORE_PATH = config.get('cache-store', 'sunfire-cache.db')
+
+
+def get_connection():
+    """
+    Opens a connection to the cache store, creating the cache table if needed.
+
+    Returns:
+        sqlite3.Connection: The connection.
+    """
+    connection = sqlite3.connect(CACHE_STORE_PATH, timeout=10)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS cache (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            accessed_at REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        )""")
+    connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (namespace, accessed_at)")
+    return connection
+
+
+def hash_file(path, *extra):
+    """
+    Computes a content hash for a file, optionally mixed with extra values such as a prompt version.
+
+    Args:
+        path (str): The path to the file.
+        *extra: Extra values that should also change the hash.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    for value in extra:
+        digest.update(f"\0{value}".encode())
+    return digest.hexdigest()
+
+
+def get_cached(namespace, key):
+    """
+    Looks up a cached value and marks it as recently used.
+
+    Args:
+        namespace (str): The cache the value belongs to.
+        key (str): The key of the value.
+
+    Returns:
+        The cached value, or None if it isn't cached.
+    """
+    connection = get_connection()
+    try:
+        with connection:
+            row = connection.execute("SELECT value FROM cache WHERE namespace = ? AND key = ?",
+                                     (namespace, key)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                               (time.time(), namespace, key))
+    finally:
+        connection.close()
+    return json.loads(row[0])
+
+
+def put_cached(namespace, key, value, max_entries):
+    """
+    Stores a value in the cache, evicting the least recently used values of the namespace beyond `max_entries`.
+
+    Args:
+        namespace (str): The cache the value belongs to.
+        key (str): The key of the value.
+        value: The value.  Must be JSON serializable.
+        max_entries (int): The maximum number of values kept in the namespace.
+    """
+    connection = get_connection()
+    try:
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO cache (namespace, key, value, accessed_at) VALUES (?, ?, ?, ?)",
+                               (namespace, key, json.dumps(value), time.time()))
+            connection.execute("""
+                DELETE FROM cache WHERE namespace = ? AND key NOT IN (
+                    SELECT key FROM cache WHERE namespace = ? ORDER BY accessed_at DESC LIMIT ?
+                )""", (namespace, namespace, max_entries))
+    finally:
+        connection.close()
@@ -1,4 +1,4 @@
-from s3_utils import get_s3_client, upload_images_from_disk_to_s3, upload_audio_from_disk_to_s3
+from s3_utils import get_s3_client, upload_images_to_s3, upload_audio_from_disk_to_s3
 from config_utils import get_config
 
 config = get_config()
@@ -8,11 +8,14 @@ config = get_config()
 
 
 def get_cloud_storage_client():
-    return get_s3_client()
+    if config.get('cloud-storage', 's3') == 's3':
+        return get_s3_client(config.get('s3-endpoint-url'))
+    else:
+        raise ValueError(f"Invalid cloud-storage value: {config['cloud-storage']}")
 
 
-def upload_images_from_disk_to_cloud(*args, **kwargs):
-    return upload_images_from_disk_to_s3(*args, **kwargs)
+def upload_images_to_cloud(*args, **kwargs):
+    return upload_images_to_s3(*args, **kwargs)
 
 
 def upload_audio_from_disk_to_cloud(*args, **kwargs):
@@ -1,5 +1,17 @@
+import os
+import threading
 import yaml
 
+# Columns of the voice data holding comma-separated lists of values, and single values
+VOICE_SET_FIELDS = ('tone', 'use', 'attributes', 'age')
+VOICE_SCALAR_FIELDS = ('gender', 'accent')
+# Spellings used in the voice data for the same value
+VOICE_VALUE_ALIASES = {'professional': 'pro', 'char': 'character', 'drama': 'dramatic', 'stories': 'story'}
+
+# Parsed voice data, by data file
+voice_catalogs = {}
+voice_catalogs_lock = threading.Lock()
+
 
 def get_config():
     """
@@ -36,32 +48,85 @@ def get_music_data(data_file):
             print(exc)
 
 
-def get_voice_data(data_file):
+def split_voice_values(value):
     """
-    Reads and returns the voice data from the specified data file.
+    Splits a multi-valued cell of the voice data into its normalized values.
 
     Parameters:
-        data_file (str): The path to the file containing the voice data.
+        value (str): The cell, e.g. "friendly, calm, pro, calm, pro".
 
     Returns:
-        list: A list of dictionaries, where each dictionary represents a voice and contains the voice data.
+        frozenset: The distinct values, e.g. {'friendly', 'calm', 'pro'}.
+    """
+    values = set()
+    for part in value.split(','):
+        part = ' '.join(part.lower().split())
+        if part:
+            values.add(VOICE_VALUE_ALIASES.get(part, part))
+    return frozenset(values)
 
-    Raises:
-        yaml.YAMLError: If there is an error parsing the YAML file.
 
+def parse_voice(headers, line):
     """
-    with open(data_file, 'r') as file:
-        try:
-            voices = []
-            data = file.readlines()
-            headers = data[0].strip().split('\t')
-            for line in data[1:]:
-                voice = {}
-                entries = line.strip().split('\t')
-                for header, value in zip(headers, entries):
-                    voice[header] = value
-                voices.append(voice)
-
-            return voices
-        except yaml.YAMLError as exc:
-            print(exc)
\ No newline at end of file
+    Parses a line of the voice data into a voice record.
+
+    Parameters:
+        headers (list): The column names.
+        line (str): The tab-separated line.
+
+    Returns:
+        dict: The voice, with the speed as a number and the multi-valued columns as sets of normalized values.
+    """
+    voice = dict(zip(headers, line.rstrip('\n').split('\t')))
+    for field in VOICE_SET_FIELDS:
+        voice[field] = split_voice_values(voice.get(field, ''))
+    for field in VOICE_SCALAR_FIELDS:
+        voice[field] = ' '.join(voice.get(field, '').lower().split())
+    voice['speed'] = float(voice['speed']) if voice.get('speed') else None
+    return voice
+
+
+def index_voices(voices):
+    """
+    Builds a lookup index of the voices: for each column and value, the positions of the voices having it.
+
+    Parameters:
+        voices (list): The voice records.
+
+    Returns:
+        dict: The index, e.g. {'tone': {'calm': (0, 1), ...}, 'gender': {'f': (0,), ...}, ...}.
+    """
+    index = {field: {} for field in VOICE_SET_FIELDS + VOICE_SCALAR_FIELDS}
+    for position, voice in enumerate(voices):
+        for field in VOICE_SET_FIELDS:
+            for value in voice[field]:
+                index[field].setdefault(value, []).append(position)
+        for field in VOICE_SCALAR_FIELDS:
+            if voice[field]:
+                index[field].setdefault(voice[field], []).append(position)
+    return {field: {value: tuple(positions) for value, positions in values.items()}
+            for field, values in index.items()}
+
+
+def get_voice_catalog(data_file):
+    """
+    Returns the parsed and indexed voice data from the specified data file.  The file is only parsed again when its
+    modification time changes.
+
+    Parameters:
+        data_file (str): The path to the tab-separated file containing the voice data.
+
+    Returns:
+        dict: The catalog, with the 'voices' (see `parse_voice`) and their 'index' (see `index_voices`).  It is shared
+        between callers and must not be modified.
+    """
+    mtime = os.stat(data_file).st_mtime_ns
+    with voice_catalogs_lock:
+        catalog = voice_catalogs.get(data_file)
+        if catalog is None or catalog['mtime'] != mtime:
+            with open(data_file, 'r') as file:
+                headers = file.readline().strip().split('\t')
+                voices = tuple(parse_voice(headers, line) for line in file if line.strip())
+            catalog = {'mtime': mtime, 'voices': voices, 'index': index_voices(voices)}
+            voice_catalogs[data_file] = catalog
+    return catalog
@@ -1,30 +1,68 @@
 import os
-from elevenlabs import save, VoiceSettings
+from elevenlabs import VoiceSettings
 from elevenlabs.client import ElevenLabs
 import requests
+import httpx
 import json
-from io import BytesIO
-from audio_utils import fit_clip_length
-
-
-def get_elevenlabs_client():
-    client = ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"))
+import hashlib
+import uuid
+import time
+import threading
+import wave
+import subprocess
+from audio_utils import fit_clip_length, probe_duration, link_file
+from config_utils import get_config
+
+config = get_config()
+# Size of the connection pool of the shared ElevenLabs client
+ELEVENLABS_MAX_CONNECTIONS = config.get('elevenlabs-max-connections', 10)
+# Format of the speech (mp3_<sample rate>_<bitrate> or pcm_<sample rate>), and the latency optimization (0-4)
+TTS_OUTPUT_FORMAT = config.get('tts-output-format', 'mp3_22050_32')
+TTS_STREAMING_LATENCY = config.get('tts-streaming-latency', 0)
+# Where the speech is streamed to as it arrives: 'disk' saves it as is, 'pcm' decodes it to PCM on the way, for the
+# next stages
+TTS_STREAM_TO = config.get('tts-stream-to', 'disk')
+# Generated speech is kept on disk, by script, voice and settings, so that repeated narrations cost nothing.  The
+# least recently used speech is evicted once the cache grows past its size limit.
+TTS_CACHE_DIR = config.get('tts-cache-dir', 'tts-cache/')
+TTS_CACHE_MAX_BYTES = config.get('tts-cache-max-bytes', 512 * 1024 * 1024)
+# How long the voice catalog is served before it is revalidated in the background (seconds)
+VOICE_CATALOG_TTL = config.get('voice-catalog-ttl', 3600)
+
+# The voice catalog, with the tone table and slim voice data derived from it on every refresh
+voice_catalog = {'voices': None, 'tones': None, 'slim': None, 'etag': None, 'fetched_at': 0, 'refreshing': False}
+voice_catalog_lock = threading.Lock()
+# Notified when a refresh finishes, for the requests waiting on the first load
+voice_catalog_refreshed = threading.Condition(voice_catalog_lock)
+voice_data_session = requests.Session()
+
+tts_cache_stats = {'hits': 0, 'misses': 0}
+tts_cache_lock = threading.Lock()
+
+
+def get_elevenlabs_client(max_connections=ELEVENLABS_MAX_CONNECTIONS):
+    # The client is thread-safe and meant to be shared, so size its connection pool for that
+    httpx_client = httpx.Client(timeout=60, limits=httpx.Limits(max_connections=max_connections,
+                                                                max_keepalive_connections=max_connections))
+    client = ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"), httpx_client=httpx_client)
     return client
 
 
-def get_voice_data():
+def fetch_voice_data(etag=None):
     """
     Retrieves voice data from the Eleven Labs API.
 
     This function sends a GET request to the Eleven Labs API endpoint
     "https://api.elevenlabs.io/v1/voices" to retrieve information about
-    available voices. The response is parsed as JSON and the list of voices
-    is returned.
+    available voices. If an ETag from a previous response is given, the
+    request is conditional and the voices are only sent again if they changed.
+
+    Args:
+        etag (str): The ETag of the previously retrieved voice data, if any.
 
     Returns:
-        list: A list of dictionaries representing the available voices. Each
-        dictionary contains information about a specific voice, including
-        its name, gender, language, and other details.
+        tuple: The list of voices (None if they have not changed since `etag`)
+        and the ETag of the response.
 
     Raises:
         JSONDecodeError: If the response from the API cannot be parsed as JSON.
@@ -32,9 +70,72 @@ def get_voice_data():
         request to the API.
     """
     url = "https://api.elevenlabs.io/v1/voices"
-    response = requests.request("GET", url)
+    headers = {'If-None-Match': etag} if etag else {}
+    response = voice_data_session.get(url, headers=headers, timeout=30)
+    if response.status_code == 304:
+        return None, etag
+    response.raise_for_status()
     d = json.loads(response.text)
-    return d['voices']
+    return d['voices'], response.headers.get('ETag')
+
+
+def refresh_voice_catalog():
+    """
+    Refreshes the cached voice catalog, and rebuilds the tone table and the slim voice data when the voices changed.
+    On failure the previous catalog is kept.
+    """
+    try:
+        voices, etag = fetch_voice_data(voice_catalog['etag'] if voice_catalog['voices'] is not None else None)
+        with voice_catalog_lock:
+            if voices is not None:
+                voice_catalog['voices'] = voices
+                voice_catalog['tones'] = build_voice_tone_data(voices)
+                voice_catalog['slim'] = build_slim_voice_data(voices)
+                voice_catalog['etag'] = etag
+            voice_catalog['fetched_at'] = time.time()
+    finally:
+        with voice_catalog_lock:
+            voice_catalog['refreshing'] = False
+            voice_catalog_refreshed.notify_all()
+
+
+def refresh_voice_catalog_in_background():
+    """Refreshes the voice catalog on a background thread, logging failures instead of raising them."""
+    try:
+        refresh_voice_catalog()
+    except Exception as e:
+        print(f"Error refreshing the voice catalog, keeping the cached one: {e}")
+
+
+def get_elevenlabs_voice_catalog():
+    """
+    Returns the cached voice catalog.
+
+    The first call loads the catalog.  Once it is older than VOICE_CATALOG_TTL, the stale catalog keeps being
+    served while a background thread revalidates it, so requests never wait for the Eleven Labs API.
+
+    Returns:
+        dict: The catalog, with the raw 'voices', the derived 'tones' table and the 'slim' voice data.
+    """
+    with voice_catalog_lock:
+        loaded = voice_catalog['voices'] is not None
+        expired = time.time() - voice_catalog['fetched_at'] > VOICE_CATALOG_TTL
+        start_refresh = not voice_catalog['refreshing'] and (not loaded or expired)
+        if start_refresh:
+            voice_catalog['refreshing'] = True
+    if not loaded:
+        if start_refresh:
+            refresh_voice_catalog()
+        else:
+            # Another thread is loading the catalog, wait for it
+            with voice_catalog_refreshed:
+                voice_catalog_refreshed.wait_for(lambda: voice_catalog['voices'] is not None
+                                                 or not voice_catalog['refreshing'])
+            if voice_catalog['voices'] is None:
+                raise RuntimeError("Couldn't load the voice catalog")
+    elif start_refresh:
+        threading.Thread(target=refresh_voice_catalog_in_background, daemon=True).start()
+    return voice_catalog
 
 
 def text_to_speech(client, dir_name, voice, narration_script):
@@ -48,12 +149,11 @@ def text_to_speech(client, dir_name, voice, narration_script):
         narration_script: The script to be converted to speech.
 
     Returns:
-        dict: A dictionary containing the filename of the generated audio file.
+        dict: A dictionary containing the filename and the duration of the generated audio file.
 
     Raises:
         KeyError: If the 'model' key is missing in the `voice` settings.
     """
-    filename = f'{voice['name']}_narration.mp3'
     # Voice data might contain model settings.  Check for that and apply defaults if needed
     print(voice)
     if 'model' not in voice:
@@ -82,11 +182,17 @@ def text_to_speech(client, dir_name, voice, narration_script):
     print(f"Model: {model}")
     print(f"Stability: {stability}")
     print(f"Similarity Boost: {similarity_boost}")
-    # Perform the text-to-speech conversion
+    name = f"{voice['name']}_narration"
+    cache_key = get_speech_cache_key(voice['voice_id'], model, stability, similarity_boost, narration_script)
+    clip = get_cached_speech(cache_key, dir_name, name)
+    if clip is not None:
+        return clip
+
+    # Perform the text-to-speech conversion.  The audio comes back in chunks as it is generated.
     response = client.text_to_speech.convert(
         voice_id=voice['voice_id'],
-        optimize_streaming_latency="0",
-        output_format="mp3_22050_32",
+        optimize_streaming_latency=TTS_STREAMING_LATENCY,
+        output_format=TTS_OUTPUT_FORMAT,
         text=f' ... {narration_script} ... ',
         model_id=model,
         voice_settings=VoiceSettings(
@@ -97,18 +203,175 @@ def text_to_speech(client, dir_name, voice, narration_script):
         ),
     )
 
-    # Create a BytesIO object to hold the audio data in memory
-    audio_stream = BytesIO()
+    clip = stream_speech(response, dir_name, name)
+    try:
+        put_cached_speech(cache_key, dir_name, clip)
+    except OSError as e:
+        # The speech is already saved for this job, so a full or unwritable cache only costs the next job a miss
+        print(f"Error caching the speech of {voice['name']}: {e}")
+    return clip
 
-    # Write each chunk of audio data to the stream
-    for chunk in response:
-        if chunk:
-            audio_stream.write(chunk)
 
-    # Reset stream position to the beginning
-    audio_stream.seek(0)
-    save(audio_stream, f'{dir_name}/{filename}')
-    return {'filename': filename}
+def get_speech_cache_key(voice_id, model, stability, similarity_boost, narration_script):
+    """
+    Computes the key of generated speech in the speech cache.  The output format and streaming mode are part of it,
+    since they change the cached file.
+
+    Args:
+        voice_id: The ID of the voice.
+        model: The ID of the model.
+        stability: The stability setting of the voice.
+        similarity_boost: The similarity boost setting of the voice.
+        narration_script: The script converted to speech.
+
+    Returns:
+        str: The hex digest of the voice, settings and script.
+    """
+    settings = [voice_id, model, stability, similarity_boost, TTS_OUTPUT_FORMAT, TTS_STREAM_TO, narration_script]
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
+
+def count_speech_cache(outcome):
+    """Counts a hit or a miss of the speech cache, and logs the running totals."""
+    with tts_cache_lock:
+        tts_cache_stats[outcome] += 1
+        print(f"Speech cache {'hit' if outcome == 'hits' else 'miss'}: "
+              f"{tts_cache_stats['hits']} hits, {tts_cache_stats['misses']} misses")
+
+
+def get_cached_speech(cache_key, dir_name, name):
+    """
+    Looks up generated speech in the speech cache, and links it into the given directory if it is there.
+
+    Args:
+        cache_key: The key of the speech (see `get_speech_cache_key`).
+        dir_name: The directory name where the audio file will be linked.
+        name: The name of the audio file, without extension.
+
+    Returns:
+        dict: A dictionary containing the filename and the duration of the audio file, or None if it isn't cached.
+    """
+    for extension in ('mp3', 'wav'):
+        cached_path = f'{TTS_CACHE_DIR}{cache_key}.{extension}'
+        filename = f'{name}.{extension}'
+        local_path = f'{dir_name}/{filename}'
+        try:
+            link_file(cached_path, local_path)
+        except OSError:
+            # Not cached, or the cache can't be read: either way the speech is generated again
+            continue
+        # Mark it as recently used.  Another job may evict it at any time, so from here on only the job's own link
+        # (or copy) is relied on.
+        try:
+            os.utime(cached_path)
+        except OSError:
+            pass
+        count_speech_cache('hits')
+        if extension == 'mp3':
+            # Same as when it was generated: the output is constant bitrate
+            duration = os.path.getsize(local_path) * 8 / (int(TTS_OUTPUT_FORMAT.split('_')[2]) * 1000)
+        else:
+            duration = probe_duration(local_path)
+        return {'filename': filename, 'duration': duration}
+    count_speech_cache('misses')
+    return None
+
+
+def put_cached_speech(cache_key, dir_name, clip):
+    """
+    Adds generated speech to the speech cache, then evicts the least recently used speech beyond the size limit.
+
+    Args:
+        cache_key: The key of the speech (see `get_speech_cache_key`).
+        dir_name: The directory name where the audio file is.
+        clip: The clip of the audio file.
+
+    Raises:
+        OSError: If the speech can't be written to the cache.
+    """
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    extension = clip['filename'].rsplit('.', 1)[-1]
+    # Several worker processes share the cache, so the temporary name must be unique across processes too
+    temporary_path = f'{TTS_CACHE_DIR}{cache_key}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+    link_file(f"{dir_name}/{clip['filename']}", temporary_path)
+    os.replace(temporary_path, f'{TTS_CACHE_DIR}{cache_key}.{extension}')
+
+    with tts_cache_lock:
+        entries = []
+        for entry in os.scandir(TTS_CACHE_DIR):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= TTS_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+def stream_speech(chunks, dir_name, name, output_format=TTS_OUTPUT_FORMAT, stream_to=TTS_STREAM_TO):
+    """
+    Writes speech to disk as its chunks arrive, without buffering the whole response.
+
+    MP3 is saved as is, or decoded to PCM by an ffmpeg process fed with the chunks when `stream_to` is 'pcm'.  PCM
+    is wrapped in a WAV file.
+
+    Args:
+        chunks: The chunks of audio.
+        dir_name: The directory name where the audio file will be saved.
+        name: The name of the audio file, without extension.
+        output_format: The format of the chunks, e.g. 'mp3_22050_32' or 'pcm_22050'.
+        stream_to: 'disk' or 'pcm'.
+
+    Returns:
+        dict: A dictionary containing the filename and the duration of the audio file.
+
+    Raises:
+        ValueError: If the output format is not supported.
+        subprocess.CalledProcessError: If ffmpeg fails to decode the speech.
+    """
+    codec, sample_rate, *bitrate = output_format.split('_')
+    size = 0
+    if codec == 'pcm':
+        # Raw 16-bit mono samples
+        filename = f'{name}.wav'
+        with wave.open(f'{dir_name}/{filename}', 'wb') as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(int(sample_rate))
+            for chunk in chunks:
+                wav_file.writeframes(chunk)
+                size += len(chunk)
+        return {'filename': filename, 'duration': size / 2 / int(sample_rate)}
+    if codec != 'mp3':
+        raise ValueError(f"Unsupported text-to-speech output format: {output_format}")
+
+    if stream_to == 'pcm':
+        filename = f'{name}.wav'
+        cmd = ["ffmpeg", "-y", "-v", "error", "-f", "mp3", "-i", "pipe:0", "-c:a", "pcm_s16le",
+               f'{dir_name}/{filename}']
+        decoder = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        try:
+            for chunk in chunks:
+                decoder.stdin.write(chunk)
+            decoder.stdin.close()
+        except BaseException:
+            decoder.kill()
+            raise
+        if decoder.wait() != 0:
+            raise subprocess.CalledProcessError(decoder.returncode, cmd)
+        return {'filename': filename, 'duration': probe_duration(f'{dir_name}/{filename}')}
+
+    filename = f'{name}.mp3'
+    with open(f'{dir_name}/{filename}', 'wb') as audio_file:
+        for chunk in chunks:
+            audio_file.write(chunk)
+            size += len(chunk)
+    # The output is constant bitrate, so its duration follows from its size
+    return {'filename': filename, 'duration': size * 8 / (int(bitrate[0]) * 1000)}
 
 
 def generate_audio_narration(client, dir_name, voice, narration_script, duration):
@@ -134,9 +397,19 @@ def generate_audio_narration(client, dir_name, voice, narration_script, duration
 
 def get_voice_tone_data():
     """
-    Retrieves voice tone data based on the provided voice data.
+    Returns the voice tone data, precomputed with the cached voice catalog (see `build_voice_tone_data`).
+
+    Returns:
+        dict: A dictionary containing the tones details.
+    """
+    return get_elevenlabs_voice_catalog()['tones']
 
-    This function retrieves voice data using the `get_voice_data` function and filters it based on a set of criteria.
+
+def build_voice_tone_data(voice_data):
+    """
+    Builds voice tone data based on the provided voice data.
+
+    This function filters the voice data based on a set of criteria.
     It creates a dictionary of tones to use cases, with each tone having a list of voices and a set of age and gender
     combinations. The function then iterates over each voice in the voice data and checks if it meets the criteria.
     If it does, the voice information is added to the corresponding tone's list of voices and its age and gender
@@ -146,7 +419,6 @@ def get_voice_tone_data():
     Returns:
         dict: A dictionary containing the tones details, where each tone is a key and the value is a dictionary with 'voices' and 'age_gender' keys. The 'voices' key contains a list of voice information dictionaries, and the 'age_gender' key contains a sorted list of age and gender combinations.
     """
-    voice_data = get_voice_data()
     tones_to_use_cases = {
         "Friendly": ["animation", "children's stories"],
         "Professional": ["news", "audiobook", "interactive", "ground reporter", "narration"],
@@ -186,13 +458,25 @@ def get_voice_tone_data():
 
 def get_slim_voice_data():
     """
-    Retrieves a slim version of voice data.
+    Returns the slim voice data, precomputed with the cached voice catalog (see `build_slim_voice_data`).
+
+    Returns:
+        list: A list of dictionaries containing voice information.
+    """
+    return get_elevenlabs_voice_catalog()['slim']
+
+
+def build_slim_voice_data(voice_data):
+    """
+    Builds a slim version of voice data.
+
+    Args:
+        voice_data (list): The voices, as returned by the Eleven Labs API.
 
     Returns:
         list: A list of dictionaries containing voice information with specific attributes such as voice_id, name,
         description, use case, accent, gender, age, and speed.
     """
-    voice_data = get_voice_data()
     slim_voice_data = []
     for voice in voice_data:
         voice_info = {
@@ -1,5 +1,6 @@
 import os
 import base64
+from io import BytesIO
 from PIL import Image, ExifTags, ImageFilter
 from pillow_heif import register_heif_opener
 import imghdr
@@ -8,6 +9,16 @@ from messaging_utils import logger
 # Make sure we can open heif files
 register_heif_opener()
 
+# The fast background mode blurs a proxy that is at most this many times smaller than the output...
+BACKGROUND_PROXY_MAX_FACTOR = 8
+# ...while keeping the blur radius on the proxy at least this large
+BACKGROUND_PROXY_MIN_RADIUS = 3
+# Images are decoded at no less than this many times the size they will end up at, leaving headroom for the
+# precise LANCZOS resize
+DECODE_OVERSAMPLE = 2
+# Images converted at upload time are shrunk to fit this size (twice the largest output dimension)
+MAX_UPLOAD_DIMENSION = 3840
+
 
 # Function to encode the image as base64
 def encode_image(image_path: str):
@@ -72,24 +83,93 @@ def hex_to_rgb(hex_color):
     return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
 
-def modify_image(image_path, desired_width, desired_height, pad_color, output_path):
+def make_blurred_background(image, desired_width, desired_height, blur_radius, background_mode='fast'):
+    """
+    Creates the blurred background that fills the padding around a non-transparent image.
+
+    In 'exact' mode the image is stretched to the full output size and blurred there.  In 'fast' mode it is shrunk
+    to a small proxy, blurred with a proportionally smaller radius and scaled back up.  A Gaussian blur removes the
+    detail that the proxy loses, so the result looks the same at a fraction of the cost.
+
+    Args:
+        image (PIL.Image.Image): The image to build the background from.
+        desired_width (int): The width of the background.
+        desired_height (int): The height of the background.
+        blur_radius (int): The blur radius at full size.
+        background_mode (str): Either 'fast' or 'exact'.
+
+    Returns:
+        PIL.Image.Image: The blurred background.
+    """
+    # Keep the proxy's blur radius at BACKGROUND_PROXY_MIN_RADIUS or more, or the upscaling starts to show
+    proxy_factor = max(1, min(BACKGROUND_PROXY_MAX_FACTOR, blur_radius // BACKGROUND_PROXY_MIN_RADIUS))
+    if background_mode == 'exact' or proxy_factor == 1:
+        return image.resize((desired_width, desired_height), Image.LANCZOS).filter(
+            ImageFilter.GaussianBlur(blur_radius))
+
+    proxy_size = (max(1, desired_width // proxy_factor), max(1, desired_height // proxy_factor))
+    proxy = image.resize(proxy_size, Image.BILINEAR, reducing_gap=2.0).filter(
+        ImageFilter.GaussianBlur(blur_radius / proxy_factor))
+    return proxy.resize((desired_width, desired_height), Image.BICUBIC)
+
+
+def get_image_data(image):
+    """
+    Returns the content of an uploaded image.  Images are normally kept in memory, but may have been spilled to disk.
+
+    Args:
+        image (dict): The image, with its content in 'data' or, if that is None, on disk.
+
+    Returns:
+        bytes: The content of the image.
     """
-    Modifies an image by resizing it and adding padding to match the desired dimensions. If the image has transparency,
-    it will be filled with the specified color. If the image does not have transparency, it will be blurred to create
-    extended edges. The modified image is then saved to the specified output path.
+    if image.get('data') is not None:
+        return image['data']
+    with open(image['local_dir'] + image['filename'], 'rb') as image_file:
+        return image_file.read()
+
+
+def open_image(source, desired_width, desired_height):
+    """
+    Opens an image for preparation at the given output size.  JPEG images are decoded at a reduced size by the
+    decoder itself (draft mode), down to about DECODE_OVERSAMPLE times the size they will be scaled to, which cuts
+    decode time and memory for large photos.  This includes the MPO JPEGs that many phone cameras produce.  Other
+    formats are decoded at full size.
 
     Args:
-        image_path (str): The path to the image file.
+        source (str or file object): The path to the image file, or a file object containing the image.
+        desired_width (int): The width of the output.
+        desired_height (int): The height of the output.
+
+    Returns:
+        PIL.Image.Image: The opened image.
+    """
+    image = Image.open(source)
+    if image.format in ('JPEG', 'MPO'):
+        original_width, original_height = image.size
+        # EXIF rotation is applied after decoding, so allow for the image ending up in either orientation
+        scaling_factor = max(min(desired_width / original_width, desired_height / original_height),
+                             min(desired_height / original_width, desired_width / original_height))
+        scaling_factor = min(scaling_factor * DECODE_OVERSAMPLE, 1)
+        image.draft(image.mode, (int(original_width * scaling_factor), int(original_height * scaling_factor)))
+    return image
+
+
+def prepare_image(image, desired_width, desired_height, pad_color, background_mode='fast'):
+    """
+    Resizes an image and pads it to match the desired dimensions. If the image has transparency, it will be filled
+    with the specified color. If the image does not have transparency, it will be blurred to create extended edges.
+
+    Args:
+        image (PIL.Image.Image): The image to prepare.
         desired_width (int): The desired width of the modified image.
         desired_height (int): The desired height of the modified image.
         pad_color (str): The color to use for padding the image, in hexadecimal format (e.g., "#FF5733").
-        output_path (str): The path to save the modified image.
+        background_mode (str): How the blurred background is made, either 'fast' or 'exact'.
 
     Returns:
-        None
+        PIL.Image.Image: The prepared image.
     """
-    # Open the image
-    image = Image.open(image_path)
     # Correct for image orientation based on EXIF data
     image = rotate_image_according_to_exif(image)
     original_width, original_height = image.size
@@ -106,18 +186,18 @@ def modify_image(image_path, desired_width, desired_height, pad_color, output_pa
     paste_x = (desired_width - new_width) // 2
     paste_y = (desired_height - new_height) // 2
 
-    # Resize the image
-    image = image.resize((new_width, new_height), Image.LANCZOS)
+    # Resize the image.  The reducing gap lets large images be box-reduced first, before the precise LANCZOS pass.
+    image = image.resize((new_width, new_height), Image.LANCZOS, reducing_gap=3.0)
     # Try to fill transparency
     if (image.mode in ('RGBA', 'LA')) or (image.mode == 'P' and 'transparency' in image.info):
         if image.mode in ('RGBA', 'LA'):
-            print("Trying to fix transparency in:", image_path)
+            print("Trying to fix transparency")
             base_mode = image.mode[:-1]
             background = Image.new(base_mode, image.size, pad_color)
             background.paste(image, image.split()[-1])  # Paste using alpha channel as mask
             image = background
         elif image.mode == 'P' and 'transparency' in image.info:
-            print("Trying to fix transparency in:", image_path)
+            print("Trying to fix transparency")
             image = image.convert("RGBA")
             base_mode = "RGB"
             background = Image.new(base_mode, image.size, pad_color)
@@ -130,8 +210,8 @@ def modify_image(image_path, desired_width, desired_height, pad_color, output_pa
     else:
         # Blur radius calculation
         blur_radius = ((paste_x + paste_y) // 2) // 4
-        blurred_background = image.resize((desired_width, desired_height), Image.LANCZOS).filter(
-            ImageFilter.GaussianBlur(blur_radius))
+        blurred_background = make_blurred_background(image, desired_width, desired_height, blur_radius,
+                                                     background_mode)
 
         # Create a new image with extended edges
         new_img = Image.new('RGB', (desired_width, desired_height))
@@ -139,36 +219,80 @@ def modify_image(image_path, desired_width, desired_height, pad_color, output_pa
 
     # Paste the scaled image onto the new image
     new_img.paste(image, (paste_x, paste_y))
+    return new_img
+
+
+def modify_image_data(data, desired_width, desired_height, pad_color, image_format, background_mode='fast'):
+    """
+    Modifies an image held in memory by resizing it and adding padding to match the desired dimensions (see
+    `prepare_image`), and returns the encoded result.
+
+    Args:
+        data (bytes): The content of the image file.
+        desired_width (int): The desired width of the modified image.
+        desired_height (int): The desired height of the modified image.
+        pad_color (str): The color to use for padding the image, in hexadecimal format (e.g., "#FF5733").
+        image_format (str): The format to encode the modified image in (e.g. 'PNG' or 'JPEG').
+        background_mode (str): How the blurred background is made, either 'fast' or 'exact'.
 
-    # Save the modified image
-    new_img.save(output_path)
+    Returns:
+        bytes: The encoded modified image.
+    """
+    image = open_image(BytesIO(data), desired_width, desired_height)
+    new_img = prepare_image(image, desired_width, desired_height, pad_color, background_mode)
+    output = BytesIO()
+    new_img.save(output, format=image_format)
+    return output.getvalue()
 
 
-def convert_image_to_png(image):
+def get_image_format(filename):
     """
-    Converts an input image to PNG format.
+    Returns the format an image file should be encoded in, based on its extension.
+
+    Args:
+        filename (str): The name of the image file.
+
+    Returns:
+        str: The image format, defaulting to 'PNG' for unknown extensions.
+    """
+    return Image.registered_extensions().get(os.path.splitext(filename)[1].lower(), 'PNG')
+
+
+def convert_image_to_png(image, max_dimension=MAX_UPLOAD_DIMENSION):
+    """
+    Converts an input image so that it can be saved in PNG format, shrinking it to fit within `max_dimension`.
+    No output is bigger than 1920x1080, so there is no point in keeping a 48 MP photo at full size.
     Args:
         image (PIL.Image.Image): An image object opened by Image.open().
+        max_dimension (int): The maximum width and height of the converted image.
     Returns:
-        PIL.Image.Image: The converted image in PNG format.
+        PIL.Image.Image: The converted image, ready to be saved as PNG.
     """
+    # The formats converted here (HEIF, AVIF, ...) are decoded at full size, there is no draft mode for them.
+    # Shrinking right away at least keeps the mode conversion and everything after it working on the small copy.
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS, reducing_gap=3.0)
+
     # Convert the image to PNG format by changing the mode if necessary
     if image.mode != 'RGB':
         image = image.convert('RGB')
 
-    # Use BytesIO to simulate saving and reloading the image, ensuring it is in PNG format
-    from io import BytesIO
-    png_image_io = BytesIO()
-    image.save(png_image_io, format='PNG')
-    png_image_io.seek(0)
-    png_image = Image.open(png_image_io)
+    return image
+
 
-    return png_image
+def compatible_image_format(image):
+    """
+    Checks whether an image is in a format the video pipeline can use as-is.
 
+    Args:
+        image (str or bytes): The path to the image file, or its content.
 
-def compatible_image_format(image_path):
+    Returns:
+        bool: True if the image is a PNG, JPEG or WebP image.
+    """
     allowed_formats = ['png', 'jpeg', 'webp']
-    return imghdr.what(image_path) in allowed_formats
+    if isinstance(image, bytes):
+        return imghdr.what(None, h=image) in allowed_formats
+    return imghdr.what(image) in allowed_formats
 
 
 def get_platform_specs(platform):
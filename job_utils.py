@@ -0,0 +1,88 @@
+import json
+import sqlite3
+import time
+from config_utils import get_config
+
+config = get_config()
+# Jobs live in a SQLite file so that every worker process sees the same state.  Presigned video URLs are valid for
+# an hour, so by default a job is forgotten an hour after its last update.
+JOB_STORE_PATH = config.get('job-store', 'sunfire-jobs.db')
+JOB_TTL = config.get('job-ttl', 3600)
+
+
+def get_connection():
+    """
+    Opens a connection to the job store, creating the jobs table if needed.
+
+    Returns:
+        sqlite3.Connection: The connection.
+    """
+    connection = sqlite3.connect(JOB_STORE_PATH, timeout=10)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            session_id TEXT PRIMARY KEY,
+            stage TEXT NOT NULL,
+            result TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )""")
+    connection.execute("CREATE INDEX IF NOT EXISTS jobs_expires_at ON jobs (expires_at)")
+    return connection
+
+
+def update_job(session_id, stage, result=None):
+    """
+    Records the current stage of a job, and its result if it has one.  Expired jobs are evicted on the way.
+
+    A job that is 'done' stays done: the video callback can arrive before the worker records that rendering started,
+    and that late update must not hide the result.
+
+    Args:
+        session_id (str): The ID of the session.
+        stage (str): The stage the job has reached (e.g. 'submitted', 'processing', 'rendering', 'done', 'failed').
+        result (dict): The result of the job, if any.  Existing results are kept when this is None.
+    """
+    now = time.time()
+    connection = get_connection()
+    try:
+        with connection:
+            connection.execute("DELETE FROM jobs WHERE expires_at < ?", (now,))
+            connection.execute("""
+                INSERT INTO jobs (session_id, stage, result, created_at, updated_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (session_id) DO UPDATE SET
+                    stage = excluded.stage,
+                    result = COALESCE(excluded.result, jobs.result),
+                    updated_at = excluded.updated_at,
+                    expires_at = excluded.expires_at
+                WHERE jobs.stage != 'done'""",
+                               (session_id, stage, json.dumps(result) if result is not None else None,
+                                now, now, now + JOB_TTL))
+    finally:
+        connection.close()
+
+
+def get_job(session_id):
+    """
+    Retrieves a job from the store.
+
+    Args:
+        session_id (str): The ID of the session.
+
+    Returns:
+        dict or None: The job's stage, result and timestamps, or None if the job is unknown or has expired.
+    """
+    connection = get_connection()
+    try:
+        row = connection.execute("SELECT * FROM jobs WHERE session_id = ? AND expires_at >= ?",
+                                 (session_id, time.time())).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return None
+    job = dict(row)
+    job['result'] = json.loads(job['result']) if job['result'] is not None else None
+    return job
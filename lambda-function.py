@@ -158,12 +158,13 @@ def process_images_and_generate_video(session_data):
                 print(f"Error downloading file {key} from bucket {bucket}: {e}")
                 return None
 
-            # Build our command
+            # Build our command.  Audio that is already AAC is muxed as is, anything else is transcoded.
+            audio_codec = "copy" if local_path.endswith(('.m4a', '.aac')) else "aac"
             cmd = ["ffmpeg", "-y",
                    "-i", output_file,
                    "-i", local_path,
                    "-c:v", "copy",
-                   "-c:a", "aac",
+                   "-c:a", audio_codec,
                    "-strict", "experimental",
                    combine_output_path]
             # Print the ffmpeg command for debugging
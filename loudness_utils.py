@@ -0,0 +1,144 @@
+import subprocess
+import numpy as np
+from cache_utils import hash_file, get_cached, put_cached
+from config_utils import get_config
+
+config = get_config()
+# Audio is analyzed as 48 kHz stereo, the rate the ITU-R BS.1770 K-weighting coefficients below are defined for
+ANALYSIS_SAMPLE_RATE = 48000
+ANALYSIS_CHANNELS = 2
+# Bump when the analysis changes, so that cached results are not reused
+ANALYSIS_VERSION = 1
+LOUDNESS_CACHE_SIZE = config.get('loudness-cache-size', 2000)
+
+# K-weighting (ITU-R BS.1770): a high shelf modelling the head, then a high pass, as (b, a) biquad coefficients
+K_WEIGHTING_FILTERS = (
+    ((1.53512485958697, -2.69169618940638, 1.19839281085285), (1.0, -1.69065929318241, 0.73248077421585)),
+    ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)),
+)
+# Gating blocks of 400 ms, overlapping by 75%
+LUFS_BLOCK_SECONDS = 0.4
+LUFS_STEP_SECONDS = 0.1
+LUFS_ABSOLUTE_GATE = -70.0
+LUFS_RELATIVE_GATE = -10.0
+
+
+def decode_audio(path, duration=None):
+    """
+    Decodes an audio file to PCM with ffmpeg.
+
+    Args:
+        path (str): The path to the audio file.
+        duration (float): Only decode this many seconds from the start of the file, if given.
+
+    Returns:
+        numpy.ndarray: The samples, as float32 in [-1, 1], shaped (frames, channels).
+
+    Raises:
+        subprocess.CalledProcessError: If the ffmpeg command fails to execute successfully.
+    """
+    cmd = ["ffmpeg", "-v", "error"] + (["-t", str(duration)] if duration is not None else []) + ["-i", path,
+           "-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(ANALYSIS_CHANNELS), "-ar", str(ANALYSIS_SAMPLE_RATE),
+           "-"]
+    result = subprocess.run(cmd, check=True, capture_output=True)
+    return np.frombuffer(result.stdout, dtype=np.float32).reshape(-1, ANALYSIS_CHANNELS)
+
+
+def to_db(value):
+    """Converts a linear amplitude or power ratio to decibels, with silence as -inf."""
+    with np.errstate(divide='ignore'):
+        return float(10 * np.log10(value))
+
+
+def k_weighted_power(samples):
+    """
+    Applies the K-weighting filter to the samples and returns their power.
+
+    The filter is applied in the frequency domain, which is vectorized.  It only keeps the magnitude response of the
+    biquads, which is all the power measurement depends on.
+
+    Args:
+        samples (numpy.ndarray): The samples, shaped (frames, channels).
+
+    Returns:
+        numpy.ndarray: The squared K-weighted samples, shaped (frames, channels).
+    """
+    frames = len(samples)
+    spectrum = np.fft.rfft(samples, axis=0)
+    z = np.exp(-1j * np.pi * np.linspace(0, 1, spectrum.shape[0]))
+    response = np.ones(spectrum.shape[0], dtype=complex)
+    for b, a in K_WEIGHTING_FILTERS:
+        response *= (b[0] + b[1] * z + b[2] * z ** 2) / (a[0] + a[1] * z + a[2] * z ** 2)
+    weighted = np.fft.irfft(spectrum * np.abs(response)[:, None], n=frames, axis=0)
+    return weighted ** 2
+
+
+def integrated_loudness(samples):
+    """
+    Computes the integrated loudness of the samples, in LUFS (ITU-R BS.1770 with its gating).
+
+    Args:
+        samples (numpy.ndarray): The samples, shaped (frames, channels), at ANALYSIS_SAMPLE_RATE.
+
+    Returns:
+        float: The loudness in LUFS, or -inf for silence or audio shorter than one block.
+    """
+    block = int(LUFS_BLOCK_SECONDS * ANALYSIS_SAMPLE_RATE)
+    step = int(LUFS_STEP_SECONDS * ANALYSIS_SAMPLE_RATE)
+    if len(samples) < block:
+        return float('-inf')
+    power = np.concatenate([np.zeros((1, samples.shape[1])), np.cumsum(k_weighted_power(samples), axis=0)])
+    starts = np.arange(0, len(samples) - block + 1, step)
+    # Mean square of each block, summed over the channels (all weighted 1 for stereo)
+    block_power = ((power[starts + block] - power[starts]) / block).sum(axis=1)
+    with np.errstate(divide='ignore'):
+        block_loudness = -0.691 + 10 * np.log10(block_power)
+    gated = block_power[block_loudness > LUFS_ABSOLUTE_GATE]
+    if not len(gated):
+        return float('-inf')
+    relative_gate = -0.691 + to_db(gated.mean()) + LUFS_RELATIVE_GATE
+    gated = block_power[block_loudness > relative_gate]
+    return -0.691 + to_db(gated.mean())
+
+
+def analyze_samples(samples):
+    """
+    Measures decoded audio.
+
+    Args:
+        samples (numpy.ndarray): The samples, shaped (frames, channels), at ANALYSIS_SAMPLE_RATE.
+
+    Returns:
+        dict: The 'duration' in seconds, the 'rms' amplitude (relative to full scale), and the 'rms_dbfs',
+        'peak_dbfs' and integrated 'lufs' levels.
+    """
+    mean_square = float(np.mean(np.square(samples, dtype=np.float64))) if samples.size else 0.0
+    peak = float(np.max(np.abs(samples))) if samples.size else 0.0
+    return {'duration': len(samples) / ANALYSIS_SAMPLE_RATE,
+            'rms': mean_square ** 0.5,
+            'rms_dbfs': to_db(mean_square),
+            'peak_dbfs': 2 * to_db(peak),
+            'lufs': integrated_loudness(samples)}
+
+
+def analyze_audio(path, duration=None):
+    """
+    Measures an audio file (see `analyze_samples`), decoding it once.  Results are cached by the file's content.
+
+    Args:
+        path (str): The path to the audio file.
+        duration (float): Only measure this many seconds from the start of the file, if given.
+
+    Returns:
+        dict: The measurements.
+    """
+    key = hash_file(path, ANALYSIS_VERSION) if duration is None else hash_file(path, ANALYSIS_VERSION, duration)
+    analysis = get_cached('loudness', key)
+    if analysis is None:
+        analysis = analyze_samples(decode_audio(path, duration))
+        # JSON has no infinities, so silence is stored as None
+        put_cached('loudness', key, {name: value if np.isfinite(value) else None for name, value in analysis.items()},
+                   LOUDNESS_CACHE_SIZE)
+    else:
+        analysis = {name: value if value is not None else float('-inf') for name, value in analysis.items()}
+    return analysis
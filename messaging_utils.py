@@ -1,39 +1,148 @@
-import time
 import sys
-from queue import Queue
-# Initialize the message queue
-message_queue = Queue()
+import time
+import threading
+from collections import deque
+
+# How long a subscriber waits for a new message before sending a keepalive (seconds)
+KEEPALIVE_INTERVAL = 10
+# How many messages are kept per session for replay.  Older messages are dropped.
+MAX_EVENTS_PER_SESSION = 200
+# How long a finished session's messages stay available to reconnecting clients (seconds)
+FINISHED_SESSION_RETENTION = 300
+# How long a session that never finished is kept after its last message (seconds)
+IDLE_SESSION_RETENTION = 3600
+
+# One channel per session.  Each channel keeps a bounded log of the session's messages, numbered with increasing
+# event IDs, and a condition that subscribers wait on.
+channels = {}
+channels_lock = threading.Lock()
+
+
+def evict_channels(now):
+    """
+    Drops the channels of sessions that finished, or went quiet, long enough ago.  Must be called with
+    `channels_lock` held.
+
+    Args:
+        now (float): The current time, as returned by time.time().
+    """
+    for session_id in list(channels):
+        channel = channels[session_id]
+        if channel['finished_at'] is not None:
+            expired = now - channel['finished_at'] > FINISHED_SESSION_RETENTION
+        else:
+            expired = now - channel['updated_at'] > IDLE_SESSION_RETENTION
+        if expired:
+            del channels[session_id]
 
 
-def message_manager():
+def get_channel(session_id, create=True):
     """
-    Generates a message manager that continuously yields messages from the message queue.
+    Returns the message channel for the given session, creating it if needed.
 
-    This function uses a global message queue to retrieve messages and yields them in a specific format.
-    The yielded messages consist of the session ID, facility, and message separated by colons.
-    If the message queue is empty, the function checks if a certain count has been reached.
-    If the count is greater than or equal to 10, it yields a keepalive message and resets the count.
-    The function sleeps for 1 second between each iteration.
+    Args:
+        session_id (str): The ID of the session.
+        create (bool): Whether to create the channel if the session has none.  Only publishers should create
+            channels, so that subscribing to made-up session IDs doesn't allocate anything.
 
     Returns:
-        Generator: A generator that yields messages in the format "data: session_id : facility : message\n\n".
+        dict or None: The channel, holding the bounded event log, the next event ID and the condition used to notify
+        subscribers, or None if the session has no channel and `create` is False.
+    """
+    now = time.time()
+    with channels_lock:
+        evict_channels(now)
+        if session_id not in channels:
+            if not create:
+                return None
+            channels[session_id] = {
+                'events': deque(maxlen=MAX_EVENTS_PER_SESSION),
+                'next_id': 1,
+                'condition': threading.Condition(),
+                'updated_at': now,
+                'finished_at': None
+            }
+        return channels[session_id]
+
+
+def has_channel(session_id):
+    """Returns whether the given session has published messages that are still available."""
+    return get_channel(session_id, create=False) is not None
+
+
+def parse_event_id(event_id):
     """
-    global message_queue
-    count = 0
+    Parses an SSE event ID, such as the one sent back by a browser in the Last-Event-ID header.
+
+    Args:
+        event_id (str): The event ID.
+
+    Returns:
+        int: The event ID as a number, or 0 if it is missing or invalid.
+    """
+    try:
+        return max(int(event_id), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def message_manager(session_id, last_event_id=0):
+    """
+    Generates a message manager that yields the messages of a single session as they are published.
+
+    Every message carries an increasing SSE event ID, so a reconnecting browser can pass the last ID it saw and
+    only receive what it missed, as long as it is still in the session's event log.  An ID beyond the last published
+    message (e.g. one from before a restart) is treated as the last published message.  Every subscriber keeps its own
+    position, so several browsers watching the same session all receive every message.  The generator blocks until
+    a new message is published instead of polling, and yields a keepalive message if nothing arrives within
+    `KEEPALIVE_INTERVAL` seconds.
+
+    Args:
+        session_id (str): The ID of the session to subscribe to.  The session must have published a message already
+            (see `has_channel`); the generator ends right away otherwise.
+        last_event_id (int): The ID of the last message the client has already received.
+
+    Returns:
+        Generator: A generator that yields messages in the format
+        "id: event_id\ndata: session_id : facility : message\n\n".
+    """
+    channel = get_channel(session_id, create=False)
+    if channel is None:
+        return
+    condition = channel['condition']
+    with condition:
+        position = min(last_event_id, channel['next_id'] - 1)
     while True:
-        if not message_queue.empty():
-            session_id, facility, message = message_queue.get()
-            yield f"data: {session_id} : {facility} : {message}\n\n"
-            sys.stdout.flush()
-        elif count >= 10:
+        with condition:
+            condition.wait_for(lambda: channel['next_id'] - 1 > position, timeout=KEEPALIVE_INTERVAL)
+            pending = [event for event in channel['events'] if event[0] > position]
+            position = max(position, channel['next_id'] - 1)
+        if pending:
+            for event_id, facility, message in pending:
+                yield f"id: {event_id}\ndata: {session_id} : {facility} : {message}\n\n"
+        else:
             yield f"data: xxx : keepalive : ping\n\n"
-            sys.stdout.flush()
-            count = 0
-        count += 1
-        time.sleep(1)
+        sys.stdout.flush()
 
 
 def logger(session_id, facility, message):
-    """Append a new message to the queue."""
-    global message_queue
-    message_queue.put((session_id, facility, message))
+    """Append a new message to the session's event log and wake up its subscribers."""
+    channel = get_channel(session_id)
+    with channel['condition']:
+        channel['events'].append((channel['next_id'], facility, message))
+        channel['next_id'] += 1
+        channel['updated_at'] = time.time()
+        channel['condition'].notify_all()
+
+
+def finish_session(session_id):
+    """
+    Marks a session as finished.  Its messages stay available for `FINISHED_SESSION_RETENTION` seconds so that
+    clients can still catch up, after which the channel is evicted.
+
+    Args:
+        session_id (str): The ID of the session.
+    """
+    with channels_lock:
+        if session_id in channels:
+            channels[session_id]['finished_at'] = time.time()
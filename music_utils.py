@@ -1,28 +1,118 @@
 import os
+import re
+import heapq
 import shutil
 import json
 from text_to_text import generic_query
 from config_utils import get_config, get_music_data
+from audio_utils import RENDITION_VERSION, link_file
 import random
 
 config = get_config()
 music_data = get_music_data(config['music-data'])
+# Trimmed, faded and measured renditions of the library, made by build_music_library.py
+MUSIC_RENDITIONS_PATH = config.get('music-renditions', 'config/music-renditions.yaml')
+music_renditions = (get_music_data(MUSIC_RENDITIONS_PATH) or {}) if os.path.exists(MUSIC_RENDITIONS_PATH) else {}
+# Only a shortlist of the library, found locally, is sent to the model.  With the 'local' selection mode nothing is
+# sent and the song is picked from the best few of the shortlist.
+MUSIC_SHORTLIST_SIZE = config.get('music-shortlist-size', 12)
+MUSIC_SELECTION_MODE = config.get('music-selection-mode', 'shortlist')
+
+# How much a match on each property of a song counts towards its score
+SONG_FIELD_WEIGHTS = {'Mood': 3, 'Genre': 2, 'Tempo': 2, 'Energy': 2, 'Instrumentation': 1, 'Descr': 1}
+# Words of the prompt that mean the same as a property value of the library
+SONG_TERM_ALIASES = {
+    'chill': 'relaxing', 'mellow': 'calm', 'soothing': 'calm', 'relaxed': 'relaxing', 'peaceful': 'calm',
+    'lively': 'energetic', 'energy': 'energetic', 'motivational': 'inspirational', 'uplifting': 'inspirational',
+    'playful': 'fun', 'happy': 'upbeat', 'positive': 'upbeat', 'corporate': 'professional', 'polished': 'professional',
+    'intense': 'dramatic', 'powerful': 'dramatic', 'epic': 'cinematic', 'moderate': 'mid', 'medium': 'mid',
+    'guitars': 'guitar', 'orchestra': 'orchestral', 'synth': 'electronic', 'edm': 'dance',
+    'quick': 'fast', 'gentle': 'slow',
+}
+# Words of the descriptions that don't tell songs apart
+SONG_STOP_WORDS = {'a', 'an', 'and', 'the', 'with', 'for', 'of', 'to', 'in', 'but', 'not', 'very', 'is', 'it', 'its',
+                   'or', 'on', 'that', 'this', 'ideal', 'feel', 'vibe', 'vibes', 'music', 'track', 'song', 'nice'}
+
+
+def song_terms(text):
+    """
+    Splits a text into the lowercase terms used by the music index.
+
+    Parameters:
+        - text: The text, e.g. a description or a prompt.
+    Returns:
+        A list of the terms, with aliases resolved and stop words dropped.
+    """
+    terms = []
+    for word in re.findall(r'[a-z]+', str(text).lower()):
+        word = SONG_TERM_ALIASES.get(word, word)
+        if word not in SONG_STOP_WORDS:
+            terms.append(word)
+    return terms
+
+
+def index_songs(songs):
+    """
+    Builds an inverted index of the music library: for each term, the positions of the songs having it and the weight
+    of the best property it appears in.
+
+    Parameters:
+        - songs: The songs of the music data.
+    Returns:
+        A dictionary of term to {position: weight}.
+    """
+    index = {}
+    for position, song in enumerate(songs):
+        for field, weight in SONG_FIELD_WEIGHTS.items():
+            values = song.get(field) or []
+            for value in values if isinstance(values, list) else [values]:
+                for term in song_terms(value):
+                    postings = index.setdefault(term, {})
+                    postings[position] = max(postings.get(position, 0), weight)
+    return index
+
+
+music_index = index_songs(music_data['Songs'])
+
+
+def shortlist_songs(prompt, size=MUSIC_SHORTLIST_SIZE):
+    """
+    Finds the songs of the library that best match a prompt, using the music index.
+
+    Parameters:
+        - prompt: The prompt describing the music.
+        - size: The maximum number of songs returned.
+    Returns:
+        A list of the best matching songs, best first.  Songs with the same score come in random order, so that the
+        same prompt doesn't always get the same song.
+    """
+    scores = {}
+    for term in set(song_terms(prompt)):
+        for position, weight in music_index.get(term, {}).items():
+            scores[position] = scores.get(position, 0) + weight
+    songs = music_data['Songs']
+    if len(scores) < size:
+        # Not enough matches, fill the shortlist with other songs
+        others = [position for position in range(len(songs)) if position not in scores]
+        for position in random.sample(others, min(size - len(scores), len(others))):
+            scores[position] = 0
+    best = heapq.nlargest(size, scores, key=lambda position: (scores[position], random.random()))
+    return [songs[position] for position in best]
 
 
 def get_text_to_music_client():
     return "sunfire"
 
 
-def make_music(text_to_text, dir_name, prompt):
+def select_song(text_to_text, prompt, songs):
     """
-    Retrieves an appropriate piece of music based on a given prompt and music data.
-    Generates a JSON message structure, queries for the music, and saves the selected music to a specified directory.
+    Asks the model to select a song among the given songs.
     Parameters:
         - text_to_text: The input text to generate the music.
-        - dir_name: The directory path to save the generated music file.
         - prompt: The prompt for selecting the music.
+        - songs: The songs to choose from.
     Returns:
-        A dictionary containing the filename of the saved music and its type.
+        The filename of the selected song.
     """
     messages = [{
         "role": "system",
@@ -40,14 +130,47 @@ def make_music(text_to_text, dir_name, prompt):
         "content": prompt
     }, {
         "role": "user",
-        "content": "Here is the music data to use for your selection:\n" + json.dumps(music_data['Songs'])
+        "content": "Here is the music data to use for your selection:\n" + json.dumps(songs)
     }]
 
-    song = random.choice(generic_query(text_to_text, messages).split(','))
+    files = {song['File'] for song in songs}
+    choices = [name.strip() for name in generic_query(text_to_text, messages).split(',') if name.strip() in files]
+    if not choices:
+        # The model didn't answer with songs from the list, fall back on the best matches
+        choices = [song['File'] for song in songs[:3]]
+    return random.choice(choices)
+
+
+def make_music(text_to_text, dir_name, prompt):
+    """
+    Retrieves an appropriate piece of music based on a given prompt and music data.
+    Shortlists the matching songs of the library, queries for the music among them (unless the selection mode is
+    'local'), and saves the selected music to a specified directory.
+    Parameters:
+        - text_to_text: The input text to generate the music.
+        - dir_name: The directory path to save the generated music file.
+        - prompt: The prompt for selecting the music.
+    Returns:
+        A dictionary containing the filename of the saved music and its type.  Music from the prepared renditions is
+        flagged as 'prepared' and comes with its 'rms' loudness.
+    """
+    shortlist = shortlist_songs(prompt)
+    print(f"Music shortlist: {', '.join(song['File'] for song in shortlist)}")
+    if MUSIC_SELECTION_MODE == 'local':
+        song = random.choice(shortlist[:3])['File']
+    else:
+        song = select_song(text_to_text, prompt, shortlist)
     song_library = music_data['Data Directory']
     if not os.path.exists(song_library + song):
         raise FileNotFoundError(f"Song not found in library: {song_library}{song}")
     filename = song
+    rendition = music_renditions.get(song)
+    if (rendition and rendition.get('Version') == RENDITION_VERSION
+            and os.path.exists(song_library + rendition['File'])):
+        # Already trimmed, faded and measured, so it only needs to be linked in
+        print("Linking Prepared Music...")
+        link_file(song_library + rendition['File'], dir_name + filename)
+        return {"filename": filename, "type": "music", "prepared": True, "rms": rendition['RMS']}
     print("Saving Music to Disk...")
     try:
         shutil.copy(song_library + song, dir_name + filename)
@@ -56,3 +179,4 @@ def make_music(text_to_text, dir_name, prompt):
 
     clip = {"filename": filename, "type": "music"}
     return clip
+
@@ -1,98 +1,312 @@
 import os
-from openai import OpenAI
+import httpx
+from openai import OpenAI, DefaultHttpxClient
 import json
 import random
+from concurrent.futures import ThreadPoolExecutor
 from messaging_utils import logger
+from config_utils import get_config
+from cache_utils import get_cached, put_cached
+
+config = get_config()
+# Size of the connection pool of the shared OpenAI client
+OPENAI_MAX_CONNECTIONS = config.get('openai-max-connections', 20)
+# How many images are described at the same time, and how long each description may take (seconds)
+IMAGE_DESCRIPTION_WORKERS = config.get('image-description-workers', 4)
+IMAGE_DESCRIPTION_TIMEOUT = config.get('image-description-timeout', 60)
+# 'single' sends one request per image, 'batch' sends up to IMAGE_DESCRIPTION_BATCH_SIZE images per request
+IMAGE_DESCRIPTION_MODE = config.get('image-description-mode', 'single')
+IMAGE_DESCRIPTION_BATCH_SIZE = config.get('image-description-batch-size', 8)
+# Descriptions are cached by image content.  Bump the prompt version whenever the description prompts change.
+IMAGE_DESCRIPTION_CACHE_SIZE = config.get('image-description-cache-size', 5000)
+DESCRIBE_PROMPT_VERSION = 1
+# Padding color for images that could not be described
+DEFAULT_PAD_COLOR = '#000000'
+
+
+def get_openai_client(max_connections=OPENAI_MAX_CONNECTIONS):
+    # Initialize OpenAI client.  It is thread-safe and meant to be shared, so size its connection pool for that.
+    http_client = DefaultHttpxClient(limits=httpx.Limits(max_connections=max_connections,
+                                                         max_keepalive_connections=max_connections))
+    return OpenAI(api_key=os.environ.get('OPENAI_KEY'), http_client=http_client)
+
+
+# Instructions shared by the single-image and multi-image description requests
+DESCRIBE_INSTRUCTIONS = [
+    {
+        "role": "system",
+        "content": "You are the assistant. You only answer in pure JSON. Your response will be parsed by "
+                   "a script and should have no formatting characters or extraneous artifacts. This "
+                   "includes newlines and other formatting."
+    },
+    {
+        "role": "system",
+        "content": "EXPLICIT REQUIREMENT: You only answer in pure JSON. No formatting characters."
+    },
+    {
+        "role": "system",
+        "content": "EXPLICIT REQUIREMENT: Legal output key names: color, dimensions, height, width, content"
+    },
+    {
+        "role": "system",
+        "content": "INSTRUCTIONS ON COLOR: \n"
+                   "  1) For Images with Transparency: Choose a color that would make for a suitable "
+                   "background color.  Text in logos should stand out.\n"
+                   "  2) For regular Images:  report the colour that would look best for padding the image."
+    },
+    {
+        "role": "system",
+        "content": "EXPLICIT REQUIREMENT: COLOR MUST BE IN HEX FORMAT (eg #FF5733)"
+    }
+]
+
+
+def make_image_url(image, url_maker):
+    """
+    Creates a pre-signed URL to an image in cloud storage.
+
+    Args:
+        image (dict): The image.
+        url_maker: A function to generate pre-signed URLs for images.
+
+    Returns:
+        str: The pre-signed URL.
+    """
+    return url_maker(
+            'get_object',
+            Params={'Bucket': image['bucket'], 'Key': image['cloud_storage_key']},
+            ExpiresIn=120  # URL expires in 2 minutes
+        )
+
+
+def apply_description(image, descr):
+    """
+    Copies a parsed image description onto the image.
+
+    Args:
+        image (dict): The image.  Updated in place.
+        descr (dict): The description returned by the model.
+
+    Returns:
+        dict: The updated image.
+    """
+    image['color'] = descr['color']
+    image['height'] = descr['dimensions']['height']
+    image['width'] = descr['dimensions']['width']
+    image['description'] = descr['content']
+    return image
+
+
+def describe_image(client, image, url_maker, timeout=IMAGE_DESCRIPTION_TIMEOUT):
+    """
+    Describes a single image and recommends a padding color for it.
+
+    Args:
+        client: The client object for interacting with the chat completions API.
+        image (dict): The image to describe.  Updated in place.
+        url_maker: A function to generate pre-signed URLs for images.
+        timeout (float): The timeout for the model call, in seconds.
+
+    Returns:
+        dict: The image updated with color, dimensions, and description.
+    """
+    describe_response = client.chat.completions.create(
+        model='gpt-4o',
+        messages=DESCRIBE_INSTRUCTIONS + [
+            {
+                "role": "user",
+                "content": "Examine the given image and describe the color, the dimensions, and content."
+            },
+            {
+                "role": "assistant",
+                "content": '{"color" : "#DDFFE1", "dimensions" : {"height" : 100, "width" : 200} , "content" : "A '
+                           'beautiful Oak tree in a green field on a sunny day"}'
+            },
+            {
+                "role": "user",
+                "content": "Examine the given image and describe the colour, the dimensions, and content."
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": make_image_url(image, url_maker)
+                        }
+                    },
+                ],
+            }
+        ],
+        max_tokens=800,
+        timeout=timeout
+    )
+    descr = json.loads(describe_response.choices[0].message.content)
+    return apply_description(image, descr)
+
 
+def describe_images_together(client, images, url_maker, timeout=IMAGE_DESCRIPTION_TIMEOUT):
+    """
+    Describes several images in a single request, sharing the instructions between them.
 
-def get_openai_client():
-    # Initialize OpenAI client
-    return OpenAI(api_key=os.environ.get('OPENAI_KEY'))
+    Args:
+        client: The client object for interacting with the chat completions API.
+        images (list): The images to describe.  Updated in place.
+        url_maker: A function to generate pre-signed URLs for images.
+        timeout (float): The timeout for the model call, in seconds.
 
+    Returns:
+        list: The images updated with color, dimensions, and description.
 
-def describe_and_recommend(session_id, client, images, url_maker):
+    Raises:
+        ValueError: If the response is not a JSON array with one valid description per image.
+    """
+    describe_response = client.chat.completions.create(
+        model='gpt-4o',
+        messages=DESCRIBE_INSTRUCTIONS + [
+            {
+                "role": "system",
+                "content": "EXPLICIT REQUIREMENT: You will be given several images. Answer with a JSON array "
+                           "containing exactly one object per image, in the order the images were given."
+            },
+            {
+                "role": "user",
+                "content": "Examine the 2 given images and describe the color, the dimensions, and content of each."
+            },
+            {
+                "role": "assistant",
+                "content": '[{"color" : "#DDFFE1", "dimensions" : {"height" : 100, "width" : 200} , "content" : "A '
+                           'beautiful Oak tree in a green field on a sunny day"}, {"color" : "#1A2B3C", '
+                           '"dimensions" : {"height" : 300, "width" : 300} , "content" : "A company logo with '
+                           'white lettering"}]'
+            },
+            {
+                "role": "user",
+                "content": f"Examine the {len(images)} given images and describe the colour, the dimensions, and "
+                           f"content of each."
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": make_image_url(image, url_maker)
+                        }
+                    } for image in images
+                ],
+            }
+        ],
+        max_tokens=400 * len(images),
+        timeout=timeout
+    )
+    try:
+        descrs = json.loads(describe_response.choices[0].message.content)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Response is not valid JSON: {e}")
+    if not isinstance(descrs, list) or len(descrs) != len(images):
+        raise ValueError(f"Expected {len(images)} descriptions in the response")
+    try:
+        # Parse everything before touching the images so that a bad entry leaves all of them untouched
+        parsed = [{'color': d['color'], 'dimensions': {'height': d['dimensions']['height'],
+                                                      'width': d['dimensions']['width']},
+                   'content': d['content']} for d in descrs]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Malformed description in the response: {e}")
+    return [apply_description(image, descr) for image, descr in zip(images, parsed)]
+
+
+def describe_and_recommend(session_id, client, images, url_maker, max_workers=IMAGE_DESCRIPTION_WORKERS,
+                           timeout=IMAGE_DESCRIPTION_TIMEOUT, mode=IMAGE_DESCRIPTION_MODE,
+                           batch_size=IMAGE_DESCRIPTION_BATCH_SIZE):
     """
     Function to describe and recommend images based on their color, dimensions, and content.
 
+    In 'single' mode every image gets its own request.  In 'batch' mode the images are sent in chunks of up to
+    `batch_size` images per request, and any chunk whose response can't be used falls back to per-image requests.
+    Images that were described before, going by a hash of their content, are served from the description cache.
+    Requests run concurrently.  A failure only affects its own image, which then gets a default color and an empty
+    description.
+
     Args:
         session_id (str): The session ID for the operation.
         client: The client object for interacting with the chat completions API.
         images (list): A list of images to describe and recommend.
         url_maker: A function to generate pre-signed URLs for images.
+        max_workers (int): The maximum number of requests running at the same time.
+        timeout (float): The timeout for each model call, in seconds.
+        mode (str): Either 'single' or 'batch'.
+        batch_size (int): The maximum number of images per request in 'batch' mode.
 
     Returns:
-        list: A list of images updated with color, dimensions, and description.
+        list: A list of images updated with color, dimensions, and description, in their original order.
+
+    Raises:
+        RuntimeError: If none of the images could be described.
+        ValueError: If the mode is invalid.
     """
-    for image in images:
+    if mode not in ('single', 'batch'):
+        raise ValueError(f"Invalid image description mode: {mode}")
 
-        # Create pre-signed URL to the cloud_storage objects
-        image_url = url_maker(
-                'get_object',
-                Params={'Bucket': image['bucket'], 'Key': image['cloud_storage_key']},
-                ExpiresIn=120  # URL expires in 2 minutes
-            )
-        describe_response = client.chat.completions.create(
-            model='gpt-4o',
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are the assistant. You only answer in pure JSON. Your response will be parsed by "
-                               "a script and should have no formatting characters or extraneous artifacts. This "
-                               "includes newlines and other formatting."
-                },
-                {
-                    "role": "system",
-                    "content": "EXPLICIT REQUIREMENT: You only answer in pure JSON. No formatting characters."
-                },
-                {
-                    "role": "system",
-                    "content": "EXPLICIT REQUIREMENT: Legal output key names: color, dimensions, height, width, content"
-                },
-                {
-                    "role": "system",
-                    "content": "INSTRUCTIONS ON COLOR: \n"
-                               "  1) For Images with Transparency: Choose a color that would make for a suitable "
-                               "background color.  Text in logos should stand out.\n"
-                               "  2) For regular Images:  report the colour that would look best for padding the image."
-                },
-                {
-                    "role": "system",
-                    "content": "EXPLICIT REQUIREMENT: COLOR MUST BE IN HEX FORMAT (eg #FF5733)"
-                },
-                {
-                    "role": "user",
-                    "content": "Examine the given image and describe the color, the dimensions, and content."
-                },
-                {
-                    "role": "assistant",
-                    "content": '{"color" : "#DDFFE1", "dimensions" : {"height" : 100, "width" : 200} , "content" : "A '
-                               'beautiful Oak tree in a green field on a sunny day"}'
-                },
-                {
-                    "role": "user",
-                    "content": "Examine the given image and describe the colour, the dimensions, and content."
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_url
-                            }
-                        },
-                    ],
-                }
-            ],
-            max_tokens=800
-        )
-        descr = json.loads(describe_response.choices[0].message.content)
-        image['color'] = descr['color']
-        image['height'] = descr['dimensions']['height']
-        image['width'] = descr['dimensions']['width']
-        image['description'] = descr['content']
-        logger(session_id, 'log', f'Received image:{image['description']}')
+    # Serve previously described images from the cache, without presigning or calling the model
+    described = set()
+    cache_keys = {}
+    for image in images:
+        try:
+            cache_keys[id(image)] = f"{image['sha256']}-{DESCRIBE_PROMPT_VERSION}"
+            cached = get_cached('image-description', cache_keys[id(image)])
+        except Exception as e:
+            print(f"Error checking the description cache for {image['filename']}: {e}")
+            cached = None
+        if cached:
+            apply_description(image, cached)
+            described.add(id(image))
+    cached_ids = set(described)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        if mode == 'batch':
+            # A chunk of one image gains nothing from the multi-image prompt, so leave it to the per-image pass
+            uncached = [image for image in images if id(image) not in described]
+            chunks = [uncached[i:i + batch_size] for i in range(0, len(uncached), batch_size)]
+            chunks = [chunk for chunk in chunks if len(chunk) > 1]
+            futures = [pool.submit(describe_images_together, client, chunk, url_maker, timeout) for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                try:
+                    future.result()
+                    described.update(id(image) for image in chunk)
+                except Exception as e:
+                    print(f"Error describing {len(chunk)} images together, describing them one by one: {e}")
+
+        pending = [image for image in images if id(image) not in described]
+        futures = [pool.submit(describe_image, client, image, url_maker, timeout) for image in pending]
+        for image, future in zip(pending, futures):
+            try:
+                future.result()
+                described.add(id(image))
+            except Exception as e:
+                print(f"Error describing image {image['filename']}: {e}")
 
+    for image in images:
+        if id(image) in described:
+            logger(session_id, 'log', f"Received image:{image['description']}")
+            if id(image) not in cached_ids and id(image) in cache_keys:
+                try:
+                    put_cached('image-description', cache_keys[id(image)],
+                               {'color': image['color'],
+                                'dimensions': {'height': image['height'], 'width': image['width']},
+                                'content': image['description']},
+                               IMAGE_DESCRIPTION_CACHE_SIZE)
+                except Exception as e:
+                    print(f"Error caching the description of {image['filename']}: {e}")
+        else:
+            logger(session_id, 'log', "Couldn't describe one of the images. Using defaults for it...")
+            image['color'] = DEFAULT_PAD_COLOR
+            image['height'] = None
+            image['width'] = None
+            image['description'] = ''
+
+    if images and not described:
+        raise RuntimeError("None of the images could be described")
     return images
 
 
@@ -291,7 +505,7 @@ def get_matching_voice(client: OpenAI, tone: str, voices: list, topic: str):
         "content": "Overall Topic of the Video: " + topic
     }, {
         "role": "user",
-        "content": "Here is the voice data: \n" + json.dumps(voices)
+        "content": "Here is the voice data: \n" + json.dumps(voices, default=sorted)
     },  {
         "role": "user",
         "content": "Respond ONLY with names of the THREE best voices as a comma-separated list. "
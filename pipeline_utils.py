@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def stage(name, run, inputs=(), outputs=()):
+    """
+    Declares a pipeline stage.
+
+    Args:
+        name (str): The name of the stage, used in error messages.
+        run (callable): A function taking the shared state dict and returning a dict of its outputs.
+        inputs (iterable): The state keys the stage reads.
+        outputs (iterable): The state keys the stage writes.
+
+    Returns:
+        dict: The stage declaration.
+    """
+    return {'name': name, 'run': run, 'inputs': list(inputs), 'outputs': list(outputs)}
+
+
+def resolve_dependencies(stages):
+    """
+    Works out which stages each stage has to wait for.
+
+    A stage depends on every other stage that produces one of its inputs.  Inputs that no stage produces are
+    expected to be present in the state before the pipeline starts.
+
+    Args:
+        stages (list): The stage declarations.
+
+    Returns:
+        dict: A mapping of stage name to the set of stage names it depends on.
+
+    Raises:
+        ValueError: If two stages produce the same output or the stages contain a cycle.
+    """
+    producers = {}
+    for s in stages:
+        for key in s['outputs']:
+            if key in producers:
+                raise ValueError(f"Output '{key}' is produced by both '{producers[key]}' and '{s['name']}'")
+            producers[key] = s['name']
+
+    dependencies = {s['name']: {producers[key] for key in s['inputs'] if key in producers} - {s['name']}
+                    for s in stages}
+
+    # Make sure the graph can actually be completed
+    remaining = {name: set(deps) for name, deps in dependencies.items()}
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError(f"Stages contain a dependency cycle: {', '.join(sorted(remaining))}")
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+    return dependencies
+
+
+def run_stages(stages, state, max_workers=4):
+    """
+    Runs the stages as a dependency graph, starting each stage as soon as the stages it depends on are done.
+
+    Independent stages run concurrently on a bounded thread pool.  The outputs returned by each stage are merged
+    into the state by the calling thread, so a stage should only rely on the inputs it declares.
+
+    Args:
+        stages (list): The stage declarations (see `stage`).
+        state (dict): The shared state.  Updated in place with the outputs of every stage.
+        max_workers (int): The maximum number of stages running at the same time.
+
+    Returns:
+        dict: The updated state.
+
+    Raises:
+        RuntimeError: If a stage fails or doesn't produce its outputs.  Stages waiting for a worker are cancelled and
+        no other stage is started.  Stages already running can't be interrupted; they finish in the background and
+        their outputs are discarded.
+    """
+    dependencies = resolve_dependencies(stages)
+    by_name = {s['name']: s for s in stages}
+    done = set()
+    running = {}
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while len(done) < len(stages):
+            for name, deps in dependencies.items():
+                if name not in done and name not in running.values() and deps <= done:
+                    running[pool.submit(by_name[name]['run'], state)] = name
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    result = future.result() or {}
+                except Exception as e:
+                    raise RuntimeError(f"Error in stage {name}: {e}") from e
+                missing = [key for key in by_name[name]['outputs'] if key not in result]
+                if missing:
+                    raise RuntimeError(f"Stage {name} did not produce: {', '.join(missing)}")
+                state.update(result)
+                done.add(name)
+    except BaseException:
+        # Don't start anything else for a failed pipeline, and don't wait for the stages that are already running
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+    return state
@@ -1,13 +1,127 @@
+import os
+import time
 import boto3
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError, ConnectionError as BotocoreConnectionError
+from config_utils import get_config
 
+config = get_config()
+# Uploads in a batch run concurrently over the client's connection pool, so the pool must be at least as large as
+# the number of uploads times the transfer concurrency of each one.
+S3_UPLOAD_WORKERS = config.get('s3-upload-workers', 8)
+S3_UPLOAD_RETRIES = config.get('s3-upload-retries', 3)
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=config.get('s3-multipart-threshold', 8 * 1024 * 1024),
+    multipart_chunksize=config.get('s3-multipart-chunksize', 8 * 1024 * 1024),
+    max_concurrency=config.get('s3-transfer-concurrency', 4),
+    use_threads=True
+)
+S3_MAX_POOL_CONNECTIONS = config.get('s3-max-pool-connections',
+                                     S3_UPLOAD_WORKERS * S3_TRANSFER_CONFIG.max_concurrency)
+# S3 error codes worth retrying
+TRANSIENT_ERROR_CODES = ('RequestTimeout', 'RequestTimeTooSkewed', 'SlowDown', 'InternalError', 'ServiceUnavailable',
+                         'Throttling', 'ThrottlingException', '500', '502', '503', '504')
 
-def get_s3_client():
-    return boto3.client('s3')
 
+def get_s3_client(endpoint_url=None):
+    # Uploads are retried with a backoff by upload_object_to_s3, so botocore only makes one attempt per request.
+    # Retrying in both places would multiply the attempts on a throttled part.
+    return boto3.client('s3', endpoint_url=endpoint_url,
+                        config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                                      retries={'mode': 'standard', 'total_max_attempts': 1}))
 
-def upload_images_from_disk_to_s3(s3, images, unique_prefix):
+
+def is_transient_error(error):
+    """
+    Tells whether an upload error is worth retrying.
+
+    Args:
+        error (Exception): The error raised by the upload.
+
+    Returns:
+        bool: True for connection problems, timeouts, throttling and server-side errors.
+    """
+    if isinstance(error, (BotocoreConnectionError, HTTPClientError)):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES
+    return False
+
+
+def upload_object_to_s3(s3, upload, transfer_config=S3_TRANSFER_CONFIG, retries=S3_UPLOAD_RETRIES):
+    """
+    Uploads one object to S3, using multipart uploads for large objects and retrying transient failures with an
+    exponential backoff.
+
+    Args:
+        s3: An S3 client object.
+        upload (dict): The object to upload: 'bucket', 'key', and either 'data' (bytes) or 'path' (a local file).
+        transfer_config (TransferConfig): The multipart and concurrency settings for the transfer.
+        retries (int): How many times a transient failure is retried.
+
+    Returns:
+        dict: The key, size, duration in seconds and number of attempts of the upload.
+    """
+    start = time.perf_counter()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            if upload.get('data') is not None:
+                s3.upload_fileobj(BytesIO(upload['data']), upload['bucket'], upload['key'], Config=transfer_config)
+                size = len(upload['data'])
+            else:
+                with open(upload['path'], 'rb') as upload_file:
+                    s3.upload_fileobj(upload_file, upload['bucket'], upload['key'], Config=transfer_config)
+                size = os.path.getsize(upload['path'])
+            return {'key': upload['key'], 'bytes': size, 'seconds': time.perf_counter() - start,
+                    'attempts': attempt}
+        except Exception as e:
+            if attempt > retries or not is_transient_error(e):
+                raise
+            print(f"Upload of {upload['key']} failed ({e}), retrying...")
+            time.sleep(0.5 * 2 ** (attempt - 1))
+
+
+def upload_batch_to_s3(s3, uploads, max_workers=S3_UPLOAD_WORKERS, transfer_config=S3_TRANSFER_CONFIG,
+                       retries=S3_UPLOAD_RETRIES):
+    """
+    Uploads several objects to S3 concurrently, sharing the client's connection pool.
+
+    Args:
+        s3: An S3 client object.
+        uploads (list): The objects to upload (see `upload_object_to_s3`).
+        max_workers (int): The maximum number of objects uploaded at the same time.
+        transfer_config (TransferConfig): The multipart and concurrency settings for each transfer.
+        retries (int): How many times a transient failure is retried, per object.
+
+    Returns:
+        list: The timings of each upload (see `upload_object_to_s3`), in the order of `uploads`.
+
+    Raises:
+        RuntimeError: If any of the uploads failed.  The other uploads are still completed.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(upload_object_to_s3, s3, upload, transfer_config, retries) for upload in uploads]
+    timings = []
+    errors = []
+    for upload, future in zip(uploads, futures):
+        try:
+            timings.append(future.result())
+        except Exception as e:
+            errors.append(f"{upload['key']}: {e}")
+    if errors:
+        raise RuntimeError(f"Failed to upload {len(errors)} of {len(uploads)} objects: {'; '.join(errors)}")
+    return timings
+
+
+def upload_images_to_s3(s3, images, unique_prefix):
     """
-    Uploads images from disk to S3 cloud storage.
+    Uploads images to S3 cloud storage, from memory or, for images that were spilled to disk, from disk.
+    The images are uploaded concurrently.
 
     Args:
         s3: An S3 client object.
@@ -17,11 +131,17 @@ def upload_images_from_disk_to_s3(s3, images, unique_prefix):
     Returns:
         The updated list of images with cloud storage keys.
     """
+    uploads = []
     for image in images:
-        s3_key = f'uploads/{unique_prefix}-{image["filename"]}'
-        with open(image['local_dir']+image['filename'], 'rb') as image_file:
-            s3.upload_fileobj(image_file, image['bucket'], s3_key)
-        image['cloud_storage_key'] = s3_key
+        uploads.append({'bucket': image['bucket'],
+                        'key': f'uploads/{unique_prefix}-{image["filename"]}',
+                        'data': image.get('data'),
+                        'path': image['local_dir'] + image['filename']})
+    timings = upload_batch_to_s3(s3, uploads)
+    for image, upload, timing in zip(images, uploads, timings):
+        image['cloud_storage_key'] = upload['key']
+        print(f"Uploaded {timing['key']}: {timing['bytes']} bytes in {timing['seconds']:.2f}s "
+              f"({timing['attempts']} attempt(s))")
     return images
 
 
@@ -41,7 +161,6 @@ def upload_audio_from_disk_to_s3(s3, audio_data, unique_prefix):
     clips = audio_data.get('clips')
     filename = clips['combined']['filename']
     s3_key = f'uploads/{unique_prefix}-{filename}'
-    with open(local_dir+filename, 'rb') as clip_file:
-        s3.upload_fileobj(clip_file, audio_data.get('bucket'), s3_key)
+    upload_object_to_s3(s3, {'bucket': audio_data.get('bucket'), 'key': s3_key, 'path': local_dir+filename})
     clips['combined']['cloud_storage_key'] = s3_key
     return audio_data
@@ -12,6 +12,8 @@ const testPopupBtn = document.getElementById('test-popup-btn');
 const dropArea = document.getElementById('drop-area');
 const progressBarContainer = document.getElementById('progressBarContainer');
 const progressBar = document.getElementById('progressBar');
+// How long each long-poll for the video URL may wait (seconds).  Keep it equal to MAX_VIDEO_URL_WAIT in sunfire.py.
+const VIDEO_URL_WAIT = 25;
 
 function clearContainers() {
         if (logContainer) {
@@ -52,12 +54,41 @@ function hidePopup() {
     videoPopup.style.display = 'none';
 }
 var eventSource; // Global event source
+var shownVideoSession = null; // Session whose video is on screen, so SSE and long-polling don't both show it
+
+function showVideo(sessionId, videoUrl) {
+    if (shownVideoSession === sessionId) {
+        return;
+    }
+    shownVideoSession = sessionId;
+    hideProgressBar();
+    resetProgressBar();
+    if (generatedVideo) {
+        generatedVideo.src = videoUrl;
+        showPopup();
+        let hyperlink = document.createElement('a');
+        hyperlink.href = videoUrl;
+        hyperlink.textContent = "Click Here to Download Video - Link Expires in 60 minutes";
+        let paragraph = document.createElement('p');
+        paragraph.appendChild(hyperlink);
+        logContainer.appendChild(paragraph)
+        logContainer.scrollTop = logContainer.scrollHeight;
+        generatedVideo.load();
+        generatedVideo.play().then(() => {
+            console.log('Video started playing');
+        }).catch((error) => {
+            console.error('Error playing video:', error);
+        });
+    } else {
+        console.error("generated-video not found");
+    }
+}
 
 function setupEventSource(sessionId) {
     if (eventSource) {
         eventSource.close(); // Close existing connection if it exists
     }
-    eventSource = new EventSource("/api/messages?session_id=${sessionId}");
+    eventSource = new EventSource(`/api/messages?session_id=${sessionId}`);
 
     eventSource.onmessage = function(event) {
         console.log('Received message:', event.data);
@@ -85,27 +116,7 @@ function setupEventSource(sessionId) {
                         logContainer.appendChild(messageElement);
                         logContainer.scrollTop = logContainer.scrollHeight;
                 } else if (facility === "video") {
-                    hideProgressBar();
-                    resetProgressBar();
-                    if (generatedVideo) {
-                        generatedVideo.src = message;
-                        showPopup();
-                        let hyperlink = document.createElement('a');
-                        hyperlink.href = message;
-                        hyperlink.textContent = "Click Here to Download Video - Link Expires in 60 minutes";
-                        let paragraph = document.createElement('p');
-                        paragraph.appendChild(hyperlink);
-                        logContainer.appendChild(paragraph)
-                        logContainer.scrollTop = logContainer.scrollHeight;
-                        generatedVideo.load();
-                        generatedVideo.play().then(() => {
-                            console.log('Video started playing');
-                        }).catch((error) => {
-                            console.error('Error playing video:', error);
-                        });
-                    } else {
-                        console.error("generated-video not found");
-                    }
+                    showVideo(sessionId, message);
                 }
             }
         }
@@ -327,47 +338,31 @@ document.addEventListener("DOMContentLoaded", function() {
 
 
 function pollResult(session_id) {
-    console.log(`Polling for session ID: ${session_id}`);  // Add this to check if polling starts
-
-    const interval = setInterval(function() {
-        console.log(`Making request to /api/get_video_url/${session_id}`);  // Add this to confirm requests are sent
-
-        fetch(`/api/get_video_url/${session_id}`)
-            .then(response => response.json())
-            .then(data => {
-                console.log('Response from server:', data);  // Log the server's response
-                if (data.status === 'success') {
-                    console.log('Result received:', data.video_url);
-                    clearInterval(interval);  // Stop polling
-                    hideProgressBar();
-                    resetProgressBar();
-                    if (generatedVideo) {
-                        generatedVideo.src = data.video_url;
-                        showPopup();
-                        let hyperlink = document.createElement('a');
-                        hyperlink.href = data.video_url;  // Fixed here
-                        hyperlink.textContent = "Click Here to Download Video - Link Expires in 60 minutes";
-                        let paragraph = document.createElement('p');
-                        paragraph.appendChild(hyperlink);
-                        logContainer.appendChild(paragraph)
-                        logContainer.scrollTop = logContainer.scrollHeight;
-                        generatedVideo.load();
-                        generatedVideo.play().then(() => {
-                            console.log('Video started playing');
-                        }).catch((error) => {
-                            console.error('Error playing video:', error);
-                        });
-                    } else {
-                        console.error("generated-video not found");
-                    }
-                } else {
-                    console.log('Still waiting for result...');
-                }
-            })
-            .catch(err => {
-                console.error('Error fetching result:', err);
-            });
-    }, 5000);  // Poll every 5 seconds
+    // The video URL is normally pushed over the event stream.  This is a fallback that long-polls the server, which
+    // holds each request open until the video is ready or its wait time runs out.
+    console.log(`Polling for session ID: ${session_id}`);
+
+    if (shownVideoSession === session_id) {
+        return;  // Already delivered over the event stream
+    }
+    fetch(`/api/get_video_url/${session_id}?wait=${VIDEO_URL_WAIT}`)
+        .then(response => response.json())
+        .then(data => {
+            console.log('Response from server:', data);  // Log the server's response
+            if (data.status === 'success') {
+                console.log('Result received:', data.video_url);
+                showVideo(session_id, data.video_url);
+            } else if (data.status === 'failed') {
+                console.log('Video generation failed.');
+            } else {
+                console.log('Still waiting for result...');
+                pollResult(session_id);
+            }
+        })
+        .catch(err => {
+            console.error('Error fetching result:', err);
+            setTimeout(() => pollResult(session_id), 5000);  // Back off before trying again
+        });
 }
 
 
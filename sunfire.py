@@ -5,17 +5,25 @@ import os
 import uuid
 import hashlib
 from pathlib import Path
+from io import BytesIO
 from dotenv import load_dotenv
-from audio_utils import trim_and_fade, combine_audio_clips
+from audio_utils import combine_audio_clips
 import requests
 import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import time
 from PIL import Image
 # noinspection PyUnresolvedReferences
 import pillow_avif
 from config_utils import get_config
-from image_utils import modify_image, compatible_image_format, convert_image_to_png, get_platform_specs
-from messaging_utils import message_manager, logger
-from cloud_storage import get_cloud_storage_client, upload_images_from_disk_to_cloud, upload_audio_from_disk_to_cloud
+from image_utils import (modify_image_data, get_image_data, get_image_format, compatible_image_format,
+                         convert_image_to_png, get_platform_specs)
+from messaging_utils import message_manager, logger, finish_session, has_channel, parse_event_id
+from pipeline_utils import stage, run_stages
+from job_utils import update_job, get_job
+from cloud_storage import get_cloud_storage_client, upload_images_to_cloud, upload_audio_from_disk_to_cloud
 from text_to_text import get_text_to_text_client, describe_and_recommend, create_narration, generate_music_prompt
 from text_to_voice import get_text_to_voice_client, get_voice_tone_data, find_voice, generate_audio_narration
 from text_to_music import get_text_to_music_client, make_music
@@ -38,9 +46,26 @@ DESTINATION_BUCKET_NAME = config['destination_bucket_name']
 API_GATEWAY_URL = config['api_gateway_url']
 SERVER_ADDR = config['server_addr']
 
-# Thread-safe results storage
-video_urls = {}
-video_urls_lock = threading.Lock()
+# Uploaded images are kept in memory up to this many bytes per session, and spilled to disk beyond that
+UPLOAD_MEMORY_LIMIT = config.get('upload-memory-limit', 64 * 1024 * 1024)
+
+# Long-lived clients shared by all jobs in this worker, created on first use (see get_clients)
+shared_clients = None
+shared_clients_lock = threading.Lock()
+
+# Process pool for CPU-bound image preparation, created on first use (see get_image_pool)
+image_pool = None
+image_pool_lock = threading.Lock()
+
+# Job state lives in the shared job store so that every worker can answer for every session.  Long-polling clients
+# in this worker wait on the condition, and re-check the store periodically in case another worker got the result.
+video_urls_ready = threading.Condition()
+# Upper bound on how long a long-poll request to /api/get_video_url may block (seconds).  A waiting request holds its
+# worker thread, so long polls need threaded or gevent workers; the cap stays under gunicorn's default 30 s timeout.
+# script.js asks for exactly this long (VIDEO_URL_WAIT), keep the two equal.
+MAX_VIDEO_URL_WAIT = 25
+# How often a long-poll request re-checks the job store (seconds)
+VIDEO_URL_RECHECK_INTERVAL = 1
 
 
 def generate_unique_prefix():
@@ -68,9 +93,42 @@ def call_api_gateway(session_data):
         return None
 
 
+def get_image_pool():
+    """
+    Returns the process pool used for image preparation, creating it on first use.
+
+    Image preparation is CPU-bound, so it runs in separate processes to use every core.  The pool is shared by all
+    jobs in this worker.  Processes are spawned rather than forked because the server is multi-threaded.
+
+    Returns:
+        ProcessPoolExecutor: The process pool.
+    """
+    global image_pool
+    with image_pool_lock:
+        if image_pool is None:
+            image_pool = ProcessPoolExecutor(max_workers=config.get('image-workers') or os.cpu_count(),
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return image_pool
+
+
+def reset_image_pool(broken_pool):
+    """
+    Drops the image process pool after it broke, so that the next call to `get_image_pool` creates a new one.
+
+    Args:
+        broken_pool (ProcessPoolExecutor): The pool that broke.  Nothing is done if another job replaced it already.
+    """
+    global image_pool
+    with image_pool_lock:
+        if image_pool is broken_pool:
+            image_pool = None
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+
+
 def modify_images(target_width, target_height, images):
     """
-    Modifies the images in the list of images.
+    Modifies the images in the list of images.  The images are prepared in parallel on the image process pool and
+    the modified images are kept in memory.
 
     Args:
         target_width (int): The target width of the images.
@@ -78,20 +136,35 @@ def modify_images(target_width, target_height, images):
         images (list): The list of images to modify.
 
     Returns:
-        list: The list of modified images.
+        list: The list of modified images, in their original order.
     """
     modified_images = images
-    for image in modified_images:
-        original_name = image['filename']
-        local_dir = image['local_dir']
-        new_name = "modified"+original_name
-        pad_color = image['color']
-        modify_image(local_dir+original_name,
-                     target_width,
-                     target_height,
-                     pad_color,
-                     local_dir+new_name)
-        image['filename'] = new_name
+    for attempt in range(2):
+        pool = get_image_pool()
+        try:
+            futures = []
+            for image in modified_images:
+                new_name = "modified"+image['filename']
+                pad_color = image['color']
+                futures.append(pool.submit(modify_image_data,
+                                           get_image_data(image),
+                                           target_width,
+                                           target_height,
+                                           pad_color,
+                                           get_image_format(new_name),
+                                           config.get('image-background-mode', 'fast')))
+            results = [future.result() for future in futures]
+            break
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for running out of memory), which breaks the pool for good.  Replace it
+            # and try once more, so that one bad image doesn't fail every job of this worker from now on.
+            reset_image_pool(pool)
+            if attempt:
+                raise
+            print("Image process pool broke, retrying with a new pool")
+    for image, data in zip(modified_images, results):
+        image['data'] = data
+        image['filename'] = "modified"+image['filename']
     return modified_images
 
 
@@ -143,25 +216,39 @@ def initialize_clients():
     return clients
 
 
-def process_images(session_id, clients, target_width, target_height, aspect_ratio, images):
+def get_clients():
+    """
+    Returns the clients shared by every job in this worker, initializing them on first use.
+
+    The clients are thread-safe and keep their HTTP connection pools alive between jobs, so connections, TLS
+    sessions and loaded service models are reused instead of being rebuilt for every job.
+
+    Returns:
+        dict: A dictionary containing the initialized clients.
+    """
+    global shared_clients
+    with shared_clients_lock:
+        if shared_clients is None:
+            shared_clients = initialize_clients()
+        return shared_clients
+
+
+def describe_images(session_id, clients, images):
     """
-    Processes the images in the list of images.
+    Uploads the original images and describes them.
 
     Args:
         session_id (str): The ID of the session.
         clients (dict): A dictionary containing the initialized clients.
-        target_width (int): The target width of the images.
-        target_height (int): The target height of the images.
-        aspect_ratio (float): The aspect ratio of the images.
-        images (list): The list of images to process.
+        images (list): The list of images to describe.
 
     Returns:
-        tuple: A tuple containing the video data, the modified images, and the destination bucket name.
+        list: The images, with their cloud storage keys, descriptions and pad colors.
     """
     cloud_storage = clients['cloud_storage']
     text_to_text = clients['text_to_text']
     try:
-        images = upload_images_from_disk_to_cloud(cloud_storage, images, session_id)
+        images = upload_images_to_cloud(cloud_storage, images, session_id)
         logger(session_id, 'log', 'Launching Image Analysis...')
         images = describe_and_recommend(session_id, text_to_text, images, cloud_storage.generate_presigned_url)
 
@@ -169,62 +256,92 @@ def process_images(session_id, clients, target_width, target_height, aspect_rati
             print(f"Image: {image['filename']}")
             print(f"Description: {image['description']}")
 
+        return images
+    except Exception as e:
+        raise RuntimeError(f"Error in image analysis: {e}")
+
+
+def prepare_images(session_id, clients, target_width, target_height, images):
+    """
+    Modifies the described images for the video and uploads them.
+
+    Args:
+        session_id (str): The ID of the session.
+        clients (dict): A dictionary containing the initialized clients.
+        target_width (int): The target width of the images.
+        target_height (int): The target height of the images.
+        images (list): The described images.  They are left untouched, since the narration reads them concurrently.
+
+    Returns:
+        list: The modified images, with their cloud storage keys.
+    """
+    cloud_storage = clients['cloud_storage']
+    try:
         logger(session_id, 'log', 'Modifying Images...')
-        modified_images = modify_images(target_width, target_height, images)
+        modified_images = modify_images(target_width, target_height, [dict(image) for image in images])
 
         logger(session_id, 'log', 'Uploading Images to the cloud...')
-        modified_images = upload_images_from_disk_to_cloud(cloud_storage, modified_images, session_id)
+        modified_images = upload_images_to_cloud(cloud_storage, modified_images, session_id)
+        # The image data has been uploaded, so drop it before the images are sent on to Lambda
+        for image in modified_images:
+            image.pop('data', None)
 
-        video_data = {'duration': 30, 'fps': 24, 'aspect_ratio': aspect_ratio}
-
-        return video_data, modified_images, DESTINATION_BUCKET_NAME
+        return modified_images
     except Exception as e:
         raise RuntimeError(f"Error in image processing: {e}")
 
 
-def generate_narrative(session_data):
+def choose_voice(session_data):
     """
-    Generates the narrative for the session.
+    Chooses the narrator for the session.
 
     Args:
         session_data (dict): The session data.
 
     Returns:
-        dict: The updated session data.
+        dict: The chosen voice.
     """
     session_id = session_data['unique_prefix']
     text_to_text = session_data['clients']['text_to_text']
-    text_to_voice = session_data['clients']['text_to_voice']
     try:
-        session_data['audio'] = {
-            'clips': {'voice': None, 'music': None, 'combined': None},
-            'bucket': SOURCE_BUCKET_NAME,
-            'narration_script': "",
-            'local_dir': session_data['audio']['local_dir']
-        }
-
         logger(session_id, 'log', 'Choosing a voice...')
         voice = find_voice(text_to_text, session_data['mood'], session_data['topic'])
         logger(session_id, 'log', f"Your narrator is: {voice['name']}")
-        session_data['voice'] = voice
+        return voice
+    except Exception as e:
+        raise RuntimeError(f"Error choosing a voice: {e}")
+
+
+def generate_narrative(session_data, images):
+    """
+    Generates the narrative for the session.
+
+    Args:
+        session_data (dict): The session data, including the chosen voice.
+        images (list): The described images.
 
+    Returns:
+        tuple: A tuple containing the narration script and the narration clip.
+    """
+    session_id = session_data['unique_prefix']
+    text_to_text = session_data['clients']['text_to_text']
+    text_to_voice = session_data['clients']['text_to_voice']
+    try:
         logger(session_id, 'log', 'Generating the narration script...')
-        narration_script = create_narration(text_to_text, session_data)
+        narration_script = create_narration(text_to_text, dict(session_data, images=images))
         print("Script: ", narration_script)
-        session_data['audio']['narration_script'] = narration_script
 
         logger(session_id, 'log', 'Generating audio narration...')
         new_audio_clip = generate_audio_narration(text_to_voice, session_data['audio']['local_dir'],
-                                                  session_data['voice'], session_data['audio']['narration_script'],
+                                                  session_data['voice'], narration_script,
                                                   session_data['video']['duration'])
-        session_data['audio']['clips']['voice'] = new_audio_clip
 
-        return session_data
+        return narration_script, new_audio_clip
     except Exception as e:
         raise RuntimeError(f"Error in narrative section: {e}")
 
 
-def generate_music(session_id, clients, mood, topic, audio_data):
+def generate_music(session_id, clients, mood, topic, save_dir):
     """
     Generates the music for the video.
 
@@ -233,13 +350,12 @@ def generate_music(session_id, clients, mood, topic, audio_data):
         clients (dict): A dictionary containing the initialized clients.
         mood (str): The mood of the video.
         topic (str): The topic of the video.
-        audio_data (dict): The audio data.
+        save_dir (str): The directory where the music clip will be saved.
 
     Returns:
-        dict: The updated audio data.
+        dict: The music clip.
     """
     text_to_text = clients['text_to_text']
-    save_dir = audio_data['local_dir']
     try:
         logger(session_id, 'log', 'Designing Music...')
         music_prompt = generate_music_prompt(text_to_text, mood, topic)
@@ -249,11 +365,8 @@ def generate_music(session_id, clients, mood, topic, audio_data):
         clip = make_music(clients, save_dir, music_prompt)
         logger(session_id, 'log', f'Song: {clip["filename"]}')
 
-        logger(session_id, 'log', 'Making Adjustments...')
-        clip = trim_and_fade(save_dir, clip)
-        audio_data['clips']['music'] = clip
-
-        return audio_data
+        # The music is trimmed and faded out when it is mixed, unless the library had it prepared already
+        return clip
     except Exception as e:
         raise RuntimeError(f"Error in music section: {e}")
 
@@ -305,6 +418,63 @@ def handoff_to_lambda(session_data):
         raise RuntimeError(f"Error in hand-off to Lambda: {e}")
 
 
+def build_stages(session_data, images):
+    """
+    Declares the stages of the video generation pipeline and the data they exchange.
+
+    Music selection and voice selection only need the mood and topic, so they can run while the images are being
+    uploaded and described.  The narration only has to wait for the image descriptions and the voice, so preparing
+    and uploading the images for the video runs alongside it.  The audio mix has to wait for both the narration and
+    the music.
+
+    Args:
+        session_data (dict): The session data.
+        images (list): The list of images to be processed.
+
+    Returns:
+        list: The stage declarations.
+    """
+    session_id = session_data['unique_prefix']
+    clients = session_data['clients']
+    audio_dir = session_data['audio']['local_dir']
+
+    def describe_stage(state):
+        return {'described_images': describe_images(session_id, clients, images)}
+
+    def prepare_images_stage(state):
+        return {'images': prepare_images(session_id, clients, state['target_width'], state['target_height'],
+                                         state['described_images'])}
+
+    def voice_stage(state):
+        return {'voice': choose_voice(state)}
+
+    def narrative_stage(state):
+        narration_script, voice_clip = generate_narrative(state, state['described_images'])
+        return {'narration_script': narration_script, 'voice_clip': voice_clip}
+
+    def music_stage(state):
+        return {'music_clip': generate_music(session_id, clients, state['mood'], state['topic'], audio_dir)}
+
+    def audio_stage(state):
+        audio_data = {
+            'clips': {'voice': state['voice_clip'], 'music': state['music_clip'], 'combined': None},
+            'bucket': SOURCE_BUCKET_NAME,
+            'narration_script': state['narration_script'],
+            'local_dir': audio_dir
+        }
+        return {'audio': combine_audio(session_id, clients['cloud_storage'], audio_data)}
+
+    return [
+        stage('describe', describe_stage, outputs=['described_images']),
+        stage('prepare_images', prepare_images_stage, inputs=['described_images'], outputs=['images']),
+        stage('voice', voice_stage, outputs=['voice']),
+        stage('narrative', narrative_stage, inputs=['voice', 'described_images'],
+              outputs=['narration_script', 'voice_clip']),
+        stage('music', music_stage, outputs=['music_clip']),
+        stage('audio', audio_stage, inputs=['narration_script', 'voice_clip', 'music_clip'], outputs=['audio']),
+    ]
+
+
 def generate_video(session_data, images):
     """
     Generates a video based on the given session data and images.
@@ -323,36 +493,29 @@ def generate_video(session_data, images):
     with ((app.app_context())):
         try:
             print('Executing the background')
+            update_job(session_data['unique_prefix'], 'processing')
+
+            session_data['clients'] = get_clients()
 
-            session_data['clients'] = initialize_clients()
-
-            print('Processing Images...')
-            (session_data['video'],
-             session_data['images'],
-             session_data['write_bucket']) = process_images(session_data['unique_prefix'],
-                                                            session_data['clients'],
-                                                            session_data['target_width'],
-                                                            session_data['target_height'],
-                                                            session_data['video']['aspect_ratio'], images)
-            session_data = generate_narrative(session_data)
-            session_data['audio'] = generate_music(session_data['unique_prefix'],
-                                                   session_data['clients'],
-                                                   session_data['mood'],
-                                                   session_data['topic'],
-                                                   session_data['audio'])
-            session_data['audio'] = combine_audio(session_data['unique_prefix'],
-                                                  session_data['clients']['cloud_storage'],
-                                                  session_data['audio'])
-
-            # Before handing off to Lambda, clear out the client objects
+            print('Running the pipeline...')
+            session_data = run_stages(build_stages(session_data, images), session_data,
+                                      max_workers=config.get('stage-workers', 4))
+
+            # Before handing off to Lambda, clear out the references to the shared client objects, and the described
+            # originals, which still hold their image data
             session_data['clients'] = {}
+            session_data.pop('described_images', None)
             # And clean up
-            return handoff_to_lambda(session_data)
+            response, status = handoff_to_lambda(session_data)
+            update_job(session_data['unique_prefix'], 'rendering' if status == 200 else 'failed')
+            return response, status
 
         except Exception as e:
             print(f"Error in generate_video: {str(e)}")
             print(traceback.format_exc())
             logger(session_data['unique_prefix'], 'error', 'video generation failed - ' + str(e))
+            update_job(session_data['unique_prefix'], 'failed')
+            finish_session(session_data['unique_prefix'])
             # endregion
 
 #############################################################################################################
@@ -395,7 +558,8 @@ def generate_video_route():
         'mood': request.form.get('mood'),
         'platform': request.form.get('platform'),
         'audio': {},
-        'video': {},
+        'video': {'duration': 30, 'fps': 24},
+        'write_bucket': DESTINATION_BUCKET_NAME,
         'text_to_text': config['text-to-text'],
         'image_to_text': config['image-to-text'],
         'text_to_voice': config['text-to-voice'],
@@ -406,54 +570,61 @@ def generate_video_route():
      session_data['target_height'],
      session_data['video']['aspect_ratio']) = (get_platform_specs(session_data['platform']))
 
-    # Create session-dependant directories
+    # Create session-dependant directories.  The upload folder is only created if uploads have to be spilled to disk.
     upload_folder = os.path.join(app.config['UPLOAD_FOLDER'], session_data['unique_prefix']) + '/'
-    os.makedirs(upload_folder, exist_ok=True)
     videos_folder = os.path.join(app.config['VIDEOS_FOLDER'], session_data['unique_prefix']) + '/'
     os.makedirs(videos_folder, exist_ok=True)
     audio_folder = os.path.join(app.config['AUDIO_FOLDER'], session_data['unique_prefix']) + '/'
     os.makedirs(audio_folder, exist_ok=True)
     session_data['audio']['local_dir'] = audio_folder
 
-    # Get the uploaded images from the request
+    # Get the uploaded images from the request.  They are kept in memory, unless the session's uploads grow past
+    # UPLOAD_MEMORY_LIMIT, in which case the rest is written to the upload folder.
     image_files = request.files.getlist('images')
     print("Image Files:", image_files)
+    images = []
+    in_memory = 0
     for image_file in image_files:
         # Clean up file names
         stem = Path(image_file.filename).stem
         ext = Path(image_file.filename).suffix
         safe_stem = hashlib.sha256(stem.encode()).hexdigest()[:20]
         safe_filename = safe_stem + ext
-        image_file.filename = safe_filename
 
-        image_path = os.path.join(upload_folder, image_file.filename)
-        image_file.save(image_path)
-        if not compatible_image_format(image_path):
+        data = image_file.read()
+        if not compatible_image_format(data):
             try:
-                with Image.open(image_path) as img:
+                with Image.open(BytesIO(data)) as img:
                     img = convert_image_to_png(img)
-                    new_filename = os.path.splitext(image_file.filename)[0] + '.png'
-                    file_path = os.path.join(upload_folder, new_filename)
-                    img.save(file_path, format='PNG')
-                    image_file.filename = new_filename
+                    converted = BytesIO()
+                    img.save(converted, format='PNG')
+                    data = converted.getvalue()
+                    safe_filename = safe_stem + '.png'
             except Exception as e:
                 print(f"Error converting image: {str(e)}")
                 logger(unique_prefix, 'log', 'Got an incompatible image. Skipping it...')
-                os.remove(image_path)
                 continue
 
-    # Keep track of image attributes
-    images = []
-    for image_file in image_files:
-        images.append(
-            {'filename': image_file.filename,
-             'local_dir': upload_folder,
-             'bucket': SOURCE_BUCKET_NAME})
+        # Keep track of image attributes
+        image = {'filename': safe_filename,
+                 'local_dir': upload_folder,
+                 'bucket': SOURCE_BUCKET_NAME,
+                 'sha256': hashlib.sha256(data).hexdigest(),
+                 'data': data}
+        if in_memory + len(data) > UPLOAD_MEMORY_LIMIT:
+            os.makedirs(upload_folder, exist_ok=True)
+            with open(upload_folder + safe_filename, 'wb') as spill_file:
+                spill_file.write(data)
+            image['data'] = None
+        else:
+            in_memory += len(data)
+        images.append(image)
 
     @copy_current_request_context
     def task():
         return generate_video(session_data, images)
 
+    update_job(session_data['unique_prefix'], 'submitted')
     future = executor.submit(task)
     app.logger.debug('Task submitted: %s', future)
     return jsonify({'status': 'Task started', 'session_id': session_data['unique_prefix']}), 202
@@ -488,8 +659,12 @@ def video_callback():
     video_url = session_data.get('video_url')
 
     if video_url:
-        with video_urls_lock:
-            video_urls[session_data['unique_prefix']] = video_url
+        update_job(session_data['unique_prefix'], 'done', {'video_url': video_url})
+        with video_urls_ready:
+            video_urls_ready.notify_all()
+        # Push the result to the browser right away instead of waiting for it to poll
+        logger(session_data['unique_prefix'], 'video', video_url)
+        finish_session(session_data['unique_prefix'])
     # Process the data here
     return jsonify({"message": "Callback received", "data": data}), 200
 
@@ -499,18 +674,29 @@ def get_video_url(session_id):
     """
     Retrieves the video URL for a given session ID.
 
+    If the 'wait' query parameter is given, the request blocks until the video URL arrives or that many seconds
+    (capped at MAX_VIDEO_URL_WAIT) have passed, so clients can long-poll with one request per job.
+
     Args:
         session_id (str): The ID of the session.
 
     Returns:
-        str: The video URL for the session, or a pending message if the session ID is not found.
+        str: The video URL for the session, a failed message if the job failed, or a pending message otherwise.
     """
-    print("Got polled")
-    with video_urls_lock:
-        if session_id in video_urls:
-            return jsonify({'status': 'success', 'video_url': video_urls[session_id]})
-        else:
-            return jsonify({'status': 'pending'})
+    wait = min(max(request.args.get('wait', 0, type=float), 0), MAX_VIDEO_URL_WAIT)
+    deadline = time.monotonic() + wait
+    job = get_job(session_id)
+    while not (job and job['stage'] in ('done', 'failed')) and time.monotonic() < deadline:
+        with video_urls_ready:
+            video_urls_ready.wait(timeout=max(min(VIDEO_URL_RECHECK_INTERVAL, deadline - time.monotonic()), 0))
+        job = get_job(session_id)
+
+    if job and job['result']:
+        return jsonify({'status': 'success', 'video_url': job['result']['video_url']})
+    elif job and job['stage'] == 'failed':
+        return jsonify({'status': 'failed'})
+    else:
+        return jsonify({'status': 'pending'})
 
 
 @app.route('/api/get_tones_data', methods=['GET'])
@@ -525,9 +711,18 @@ def get_tones_data():
 @app.route('/api/messages')
 def stream_messages():
     """
-    Defines the route '/api/messages' that streams messages to the client in text/event-stream format.
+    Defines the route '/api/messages' that streams the messages of one session to the client in text/event-stream
+    format.  The session is selected with the 'session_id' query parameter, and must be one this worker has
+    published messages for.
     """
-    return Response(message_manager(), mimetype='text/event-stream')
+    session_id = request.args.get('session_id')
+    if not session_id:
+        return jsonify({'error': 'session_id is required'}), 400
+    if not has_channel(session_id):
+        return jsonify({'error': 'Unknown session'}), 404
+    # Browsers send Last-Event-ID when they reconnect, so only replay what they missed
+    last_event_id = parse_event_id(request.headers.get('Last-Event-ID'))
+    return Response(message_manager(session_id, last_event_id), mimetype='text/event-stream')
 
 
 if __name__ == '__main__':
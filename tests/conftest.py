@@ -0,0 +1,18 @@
+import os
+import sys
+import pytest
+
+# The modules read config/sunfire-config.yaml relative to the working directory when they are imported
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(autouse=True)
+def stores(tmp_path, monkeypatch):
+    """Points the job store and the cache store at a fresh directory for every test."""
+    import cache_utils
+    import job_utils
+    monkeypatch.setattr(job_utils, 'JOB_STORE_PATH', str(tmp_path / 'jobs.db'))
+    monkeypatch.setattr(cache_utils, 'CACHE_STORE_PATH', str(tmp_path / 'cache.db'))
+    return tmp_path
@@ -0,0 +1,48 @@
+import time
+from cache_utils import hash_file, get_cached, put_cached
+
+
+def test_missing_value():
+    assert get_cached('descriptions', 'nope') is None
+
+
+def test_values_round_trip_as_json():
+    put_cached('descriptions', 'k', {'description': 'a cat', 'color': '#102030'}, 10)
+    assert get_cached('descriptions', 'k') == {'description': 'a cat', 'color': '#102030'}
+
+
+def test_namespaces_are_separate():
+    put_cached('descriptions', 'k', 'description', 10)
+    put_cached('loudness', 'k', 'loudness', 10)
+    assert get_cached('descriptions', 'k') == 'description'
+    assert get_cached('loudness', 'k') == 'loudness'
+
+
+def test_least_recently_used_values_are_evicted():
+    for key in ('a', 'b', 'c'):
+        put_cached('ns', key, key, 3)
+        time.sleep(0.01)
+    # Reading 'a' makes 'b' the least recently used
+    assert get_cached('ns', 'a') == 'a'
+    time.sleep(0.01)
+    put_cached('ns', 'd', 'd', 3)
+    assert get_cached('ns', 'b') is None
+    assert [get_cached('ns', key) for key in ('a', 'c', 'd')] == ['a', 'c', 'd']
+
+
+def test_eviction_is_per_namespace():
+    put_cached('other', 'keep', 'keep', 1)
+    for key in ('a', 'b'):
+        put_cached('ns', key, key, 1)
+    assert get_cached('other', 'keep') == 'keep'
+    assert get_cached('ns', 'a') is None
+
+
+def test_hash_file_depends_on_content_and_extra(tmp_path):
+    first, second = tmp_path / 'first', tmp_path / 'second'
+    first.write_bytes(b'image')
+    second.write_bytes(b'image')
+    assert hash_file(str(first)) == hash_file(str(second))
+    assert hash_file(str(first), 1) != hash_file(str(first), 2)
+    second.write_bytes(b'other image')
+    assert hash_file(str(first)) != hash_file(str(second))
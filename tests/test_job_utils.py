@@ -0,0 +1,56 @@
+import job_utils
+from job_utils import update_job, get_job
+
+
+def test_unknown_job():
+    assert get_job('nope') is None
+
+
+def test_stages_and_results_are_recorded():
+    update_job('s', 'submitted')
+    assert get_job('s')['stage'] == 'submitted'
+    assert get_job('s')['result'] is None
+    update_job('s', 'done', {'video_url': 'https://example.com/video.mp4'})
+    job = get_job('s')
+    assert job['stage'] == 'done'
+    assert job['result'] == {'video_url': 'https://example.com/video.mp4'}
+
+
+def test_result_is_kept_by_later_updates():
+    update_job('s', 'processing', {'partial': True})
+    update_job('s', 'rendering')
+    assert get_job('s')['result'] == {'partial': True}
+
+
+def test_done_is_not_overwritten():
+    update_job('s', 'processing')
+    # The callback can beat the worker's own 'rendering' update
+    update_job('s', 'done', {'video_url': 'url'})
+    update_job('s', 'rendering')
+    update_job('s', 'failed')
+    job = get_job('s')
+    assert job['stage'] == 'done'
+    assert job['result'] == {'video_url': 'url'}
+
+
+def test_created_at_is_kept():
+    update_job('s', 'submitted')
+    created_at = get_job('s')['created_at']
+    update_job('s', 'processing')
+    job = get_job('s')
+    assert job['created_at'] == created_at
+    assert job['updated_at'] >= created_at
+
+
+def test_expired_jobs_are_forgotten(monkeypatch):
+    monkeypatch.setattr(job_utils, 'JOB_TTL', -1)
+    update_job('old', 'done', {'video_url': 'url'})
+    assert get_job('old') is None
+    monkeypatch.setattr(job_utils, 'JOB_TTL', 3600)
+    update_job('new', 'submitted')
+    # The expired job was evicted from the store on the way
+    connection = job_utils.get_connection()
+    try:
+        assert [row['session_id'] for row in connection.execute("SELECT session_id FROM jobs")] == ['new']
+    finally:
+        connection.close()
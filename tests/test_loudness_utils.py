@@ -0,0 +1,58 @@
+import shutil
+import subprocess
+import numpy as np
+import pytest
+import loudness_utils
+from loudness_utils import ANALYSIS_SAMPLE_RATE, integrated_loudness, analyze_samples, analyze_audio
+
+
+def tone(amplitude_dbfs, seconds=5.0, frequency=997, channels=(True, True)):
+    """A sine tone at the given peak level, on the selected channels."""
+    t = np.arange(int(seconds * ANALYSIS_SAMPLE_RATE)) / ANALYSIS_SAMPLE_RATE
+    wave = 10 ** (amplitude_dbfs / 20) * np.sin(2 * np.pi * frequency * t)
+    return np.stack([wave if on else np.zeros_like(wave) for on in channels], axis=1).astype(np.float32)
+
+
+# Reference levels of ITU-R BS.1770 / EBU Tech 3341: a 997 Hz sine at -23 dBFS on both channels is -23 LUFS
+@pytest.mark.parametrize('level', [-23.0, -33.0, -6.0])
+def test_stereo_reference_tone(level):
+    assert integrated_loudness(tone(level)) == pytest.approx(level, abs=0.1)
+
+
+def test_single_channel_is_3_db_quieter():
+    assert integrated_loudness(tone(-20.0, channels=(True, False))) == pytest.approx(-23.0, abs=0.1)
+
+
+def test_silence_and_short_audio_are_minus_infinity():
+    assert integrated_loudness(np.zeros((ANALYSIS_SAMPLE_RATE * 2, 2), dtype=np.float32)) == float('-inf')
+    assert integrated_loudness(tone(-23.0, seconds=0.3)) == float('-inf')
+
+
+def test_quiet_passages_are_gated_out():
+    # 20 dB below the loud part, so under the relative gate: the loudness is that of the loud part alone
+    samples = np.concatenate([tone(-23.0, seconds=10), tone(-43.0, seconds=10)])
+    assert integrated_loudness(samples) == pytest.approx(-23.0, abs=0.2)
+
+
+def test_analyze_samples_levels():
+    analysis = analyze_samples(tone(-6.0, seconds=2))
+    assert analysis['duration'] == pytest.approx(2.0)
+    assert analysis['peak_dbfs'] == pytest.approx(-6.0, abs=0.01)
+    # The RMS of a sine is 3 dB below its peak
+    assert analysis['rms_dbfs'] == pytest.approx(-9.01, abs=0.01)
+    assert analysis['rms'] == pytest.approx(10 ** (-9.01 / 20), rel=0.01)
+    assert analysis['lufs'] == pytest.approx(-6.0, abs=0.1)
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg is not installed")
+def test_analyze_audio_is_cached_per_content_and_duration(tmp_path, monkeypatch):
+    path = str(tmp_path / 'tone.wav')
+    subprocess.run(["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "sine=f=997:d=4", "-ac", "2", path], check=True)
+    decodes = []
+    decode_audio = loudness_utils.decode_audio
+    monkeypatch.setattr(loudness_utils, 'decode_audio', lambda *args: decodes.append(args) or decode_audio(*args))
+    first = analyze_audio(path)
+    assert analyze_audio(path) == first
+    assert first['duration'] == pytest.approx(4.0, abs=0.01)
+    assert analyze_audio(path, 1)['duration'] == pytest.approx(1.0, abs=0.01)
+    assert decodes == [(path, None), (path, 1)]
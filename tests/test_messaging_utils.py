@@ -0,0 +1,76 @@
+import threading
+import pytest
+import messaging_utils
+from messaging_utils import message_manager, logger, finish_session, has_channel, parse_event_id
+
+
+@pytest.fixture(autouse=True)
+def channels(monkeypatch):
+    monkeypatch.setattr(messaging_utils, 'channels', {})
+    monkeypatch.setattr(messaging_utils, 'KEEPALIVE_INTERVAL', 0.05)
+    return messaging_utils.channels
+
+
+def event_ids(messages):
+    return [int(message.split('\n')[0][len('id: '):]) for message in messages]
+
+
+def test_messages_are_numbered_and_replayed():
+    for n in range(3):
+        logger('s', 'log', f'message {n}')
+    manager = message_manager('s')
+    messages = [next(manager) for _ in range(3)]
+    assert event_ids(messages) == [1, 2, 3]
+    assert messages[2] == "id: 3\ndata: s : log : message 2\n\n"
+
+
+def test_reconnect_only_replays_missed_messages():
+    for n in range(5):
+        logger('s', 'log', f'message {n}')
+    manager = message_manager('s', last_event_id=3)
+    assert event_ids([next(manager), next(manager)]) == [4, 5]
+    assert next(manager).endswith('keepalive : ping\n\n')
+
+
+def test_event_id_beyond_the_log_is_clamped():
+    logger('s', 'log', 'before restart')
+    manager = message_manager('s', last_event_id=100)
+    assert next(manager).endswith('keepalive : ping\n\n')
+    logger('s', 'log', 'after')
+    assert next(manager) == "id: 2\ndata: s : log : after\n\n"
+
+
+def test_event_log_is_bounded(monkeypatch):
+    monkeypatch.setattr(messaging_utils, 'MAX_EVENTS_PER_SESSION', 3)
+    for n in range(10):
+        logger('s', 'log', f'message {n}')
+    manager = message_manager('s')
+    assert event_ids([next(manager) for _ in range(3)]) == [8, 9, 10]
+
+
+def test_subscriber_is_woken_by_new_messages():
+    logger('s', 'log', 'first')
+    manager = message_manager('s', last_event_id=1)
+    threading.Timer(0.01, logger, ('s', 'video', 'url')).start()
+    messages = []
+    while not messages or 'keepalive' in messages[-1]:
+        messages.append(next(manager))
+    assert messages[-1] == "id: 2\ndata: s : video : url\n\n"
+
+
+def test_unknown_sessions_get_no_channel(channels):
+    assert list(message_manager('unknown')) == []
+    assert not has_channel('unknown')
+    assert 'unknown' not in channels
+
+
+def test_finished_sessions_are_evicted(monkeypatch):
+    logger('done', 'log', 'bye')
+    finish_session('done')
+    monkeypatch.setattr(messaging_utils, 'FINISHED_SESSION_RETENTION', -1)
+    assert not has_channel('done')
+
+
+@pytest.mark.parametrize('header, expected', [('7', 7), (None, 0), ('junk', 0), ('-3', 0)])
+def test_parse_event_id(header, expected):
+    assert parse_event_id(header) == expected
@@ -0,0 +1,58 @@
+import pytest
+import music_utils
+from music_utils import song_terms, index_songs, shortlist_songs, select_song
+
+SONGS = [
+    {'File': 'calm.mp3', 'Descr': 'Soft piano for a peaceful morning', 'Genre': 'Ambient', 'Mood': ['Calm'],
+     'Tempo': 'Slow', 'Energy': 'Low', 'Instrumentation': ['Piano']},
+    {'File': 'rock.mp3', 'Descr': 'Driving guitars', 'Genre': 'Rock', 'Mood': ['Energetic', 'Dramatic'],
+     'Tempo': 'Fast', 'Energy': 'High', 'Instrumentation': ['Guitar', 'Drums']},
+    {'File': 'corporate.mp3', 'Descr': 'Clean and confident', 'Genre': 'Pop', 'Mood': ['Professional', 'Upbeat'],
+     'Tempo': 'Mid', 'Energy': 'Medium', 'Instrumentation': ['Synth']},
+    {'File': 'epic.mp3', 'Descr': 'Huge orchestral build', 'Genre': 'Cinematic', 'Mood': ['Dramatic'],
+     'Tempo': 'Mid', 'Energy': 'High', 'Instrumentation': ['Orchestra']},
+]
+
+
+@pytest.fixture(autouse=True)
+def library(monkeypatch):
+    monkeypatch.setattr(music_utils, 'music_data', {'Data Directory': 'music-library/', 'Songs': SONGS})
+    monkeypatch.setattr(music_utils, 'music_index', index_songs(SONGS))
+
+
+def test_terms_resolve_aliases_and_drop_stop_words():
+    assert song_terms('A mellow track with guitars, very chill') == ['calm', 'guitar', 'relaxing']
+
+
+def test_index_keeps_the_best_weight_per_song():
+    index = index_songs(SONGS)
+    # 'dramatic' is a mood of rock.mp3 and epic.mp3
+    assert index['dramatic'] == {1: 3, 3: 3}
+    # 'calm' is a mood of calm.mp3, 'piano' only in its description and instrumentation
+    assert index['piano'] == {0: 1}
+    assert index['calm'] == {0: 3}
+
+
+def test_best_match_comes_first():
+    assert shortlist_songs('soothing, peaceful piano', size=2)[0]['File'] == 'calm.mp3'
+    assert shortlist_songs('powerful epic orchestra', size=2)[0]['File'] == 'epic.mp3'
+
+
+def test_shortlist_is_filled_with_other_songs():
+    shortlist = shortlist_songs('corporate', size=3)
+    assert shortlist[0]['File'] == 'corporate.mp3'
+    assert len({song['File'] for song in shortlist}) == 3
+
+
+def test_shortlist_is_capped_by_the_library():
+    assert len(shortlist_songs('anything', size=10)) == len(SONGS)
+
+
+def test_unmatched_answer_falls_back_on_the_shortlist(monkeypatch):
+    monkeypatch.setattr(music_utils, 'generic_query', lambda client, messages: 'not-in-the-list.mp3')
+    assert select_song(None, 'rock', SONGS[1:]) in ('rock.mp3', 'corporate.mp3', 'epic.mp3')
+
+
+def test_answer_is_restricted_to_the_shortlist(monkeypatch):
+    monkeypatch.setattr(music_utils, 'generic_query', lambda client, messages: 'made-up.mp3, epic.mp3')
+    assert select_song(None, 'epic', SONGS) == 'epic.mp3'
@@ -0,0 +1,149 @@
+import json
+import threading
+import types
+import pytest
+import openai_utils
+from openai_utils import describe_and_recommend, DEFAULT_PAD_COLOR
+
+
+def description(key):
+    return {'color': f'#{ord(key[0]):06X}', 'dimensions': {'height': len(key), 'width': 2 * len(key)},
+            'content': f'A picture of {key}'}
+
+
+class FakeOpenAI:
+    """
+    Answers description requests from the image URLs they contain.  The URL of an image is its storage key, and
+    images listed in `failing` make the request fail.  `batch_reply` can replace the answer to multi-image requests.
+    """
+
+    def __init__(self, failing=(), batch_reply=None, barrier=None):
+        self.failing = set(failing)
+        self.batch_reply = batch_reply
+        self.barrier = barrier
+        self.requests = []
+        self.lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, max_tokens, timeout):
+        urls = [part['image_url']['url'] for part in messages[-1]['content']]
+        with self.lock:
+            self.requests.append(urls)
+        if self.barrier is not None:
+            self.barrier.wait()
+        if self.failing & set(urls):
+            raise TimeoutError(f"Timed out on {urls}")
+        if len(urls) == 1:
+            content = json.dumps(description(urls[0]))
+        elif self.batch_reply is not None:
+            content = self.batch_reply
+        else:
+            content = json.dumps([description(url) for url in urls])
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content))])
+
+
+def url_maker(method, Params, ExpiresIn):
+    return Params['Key']
+
+
+def make_images(*keys):
+    return [{'filename': f'{key}.jpg', 'bucket': 'b', 'cloud_storage_key': key, 'sha256': f'sha-{key}'}
+            for key in keys]
+
+
+def describe(client, images, **kwargs):
+    return describe_and_recommend('session', client, images, url_maker, **kwargs)
+
+
+def test_images_are_described_in_order():
+    images = describe(FakeOpenAI(), make_images('a', 'b', 'c'), mode='single')
+    assert [image['description'] for image in images] == ['A picture of a', 'A picture of b', 'A picture of c']
+    assert images[1]['color'] == description('b')['color']
+    assert (images[2]['height'], images[2]['width']) == (1, 2)
+
+
+def test_images_are_described_concurrently():
+    client = FakeOpenAI(barrier=threading.Barrier(3, timeout=5))
+    describe(client, make_images('a', 'b', 'c'), mode='single', max_workers=3)
+    assert len(client.requests) == 3
+
+
+def test_failed_image_gets_defaults():
+    images = describe(FakeOpenAI(failing={'b'}), make_images('a', 'b', 'c'), mode='single')
+    assert images[1]['color'] == DEFAULT_PAD_COLOR
+    assert (images[1]['height'], images[1]['width'], images[1]['description']) == (None, None, '')
+    assert images[2]['description'] == 'A picture of c'
+
+
+def test_all_failures_are_an_error():
+    with pytest.raises(RuntimeError, match='None of the images'):
+        describe(FakeOpenAI(failing={'a', 'b'}), make_images('a', 'b'), mode='single')
+
+
+def test_invalid_mode():
+    with pytest.raises(ValueError):
+        describe(FakeOpenAI(), make_images('a'), mode='parallel')
+
+
+def test_batches_keep_the_input_order():
+    client = FakeOpenAI()
+    images = describe(client, make_images('a', 'b', 'c', 'd', 'e'), mode='batch', batch_size=2)
+    assert [image['description'] for image in images] == [f'A picture of {key}' for key in 'abcde']
+    # Two batches of two, and the chunk of one left over is described on its own
+    assert sorted(client.requests) == [['a', 'b'], ['c', 'd'], ['e']]
+
+
+@pytest.mark.parametrize('reply', [
+    'not json',
+    json.dumps([description('a')]),
+    json.dumps([description('a'), {'color': '#FFFFFF'}]),
+    json.dumps({'color': '#FFFFFF'}),
+])
+def test_malformed_batch_reply_falls_back_to_single_images(reply):
+    client = FakeOpenAI(batch_reply=reply)
+    images = describe(client, make_images('a', 'b'), mode='batch', batch_size=2)
+    assert [image['description'] for image in images] == ['A picture of a', 'A picture of b']
+    assert client.requests == [['a', 'b'], ['a'], ['b']]
+
+
+def test_failed_batch_only_affects_its_own_images():
+    client = FakeOpenAI(failing={'c'})
+    images = describe(client, make_images('a', 'b', 'c', 'd'), mode='batch', batch_size=2)
+    assert [image['description'] for image in images] == ['A picture of a', 'A picture of b', '', 'A picture of d']
+    assert images[2]['color'] == DEFAULT_PAD_COLOR
+
+
+def test_second_call_is_a_cache_hit():
+    client = FakeOpenAI()
+    describe(client, make_images('a', 'b'), mode='single')
+    images = describe(client, make_images('a', 'b'), mode='single')
+    assert len(client.requests) == 2
+    assert [image['description'] for image in images] == ['A picture of a', 'A picture of b']
+    assert (images[0]['color'], images[0]['height'], images[0]['width']) == ('#000061', 1, 2)
+
+
+def test_cache_is_keyed_by_content_and_prompt_version(monkeypatch):
+    client = FakeOpenAI()
+    describe(client, make_images('a'), mode='single')
+    renamed = make_images('a')
+    renamed[0]['filename'] = 'other-name.jpg'
+    describe(client, renamed, mode='single')
+    assert len(client.requests) == 1
+    monkeypatch.setattr(openai_utils, 'DESCRIBE_PROMPT_VERSION', openai_utils.DESCRIBE_PROMPT_VERSION + 1)
+    describe(client, make_images('a'), mode='single')
+    assert len(client.requests) == 2
+
+
+def test_failures_are_not_cached():
+    describe(FakeOpenAI(failing={'b'}), make_images('a', 'b'), mode='single')
+    client = FakeOpenAI()
+    images = describe(client, make_images('a', 'b'), mode='single')
+    assert client.requests == [['b']]
+    assert images[1]['description'] == 'A picture of b'
+
+
+def test_batch_results_are_cached():
+    describe(FakeOpenAI(), make_images('a', 'b'), mode='batch', batch_size=2)
+    client = FakeOpenAI()
+    describe(client, make_images('a', 'b'), mode='batch', batch_size=2)
+    assert client.requests == []
@@ -0,0 +1,86 @@
+import threading
+import time
+import pytest
+from pipeline_utils import stage, resolve_dependencies, run_stages
+
+
+def test_dependencies_follow_inputs_and_outputs():
+    stages = [stage('a', None, outputs=['x']),
+              stage('b', None, inputs=['x', 'given'], outputs=['y']),
+              stage('c', None, inputs=['x', 'y'])]
+    assert resolve_dependencies(stages) == {'a': set(), 'b': {'a'}, 'c': {'a', 'b'}}
+
+
+def test_cycle_is_rejected():
+    stages = [stage('a', None, inputs=['y'], outputs=['x']),
+              stage('b', None, inputs=['x'], outputs=['y'])]
+    with pytest.raises(ValueError, match='cycle'):
+        resolve_dependencies(stages)
+
+
+def test_duplicate_output_is_rejected():
+    stages = [stage('a', None, outputs=['x']), stage('b', None, outputs=['x'])]
+    with pytest.raises(ValueError, match="'x'"):
+        resolve_dependencies(stages)
+
+
+def test_outputs_are_passed_along():
+    stages = [stage('double', lambda state: {'y': state['x'] * 2}, inputs=['x'], outputs=['y']),
+              stage('add', lambda state: {'z': state['x'] + state['y']}, inputs=['x', 'y'], outputs=['z'])]
+    assert run_stages(stages, {'x': 3}) == {'x': 3, 'y': 6, 'z': 9}
+
+
+def test_independent_stages_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def meet(key):
+        return lambda state: barrier.wait() is not None and {key: True}
+
+    stages = [stage('a', meet('a'), outputs=['a']), stage('b', meet('b'), outputs=['b'])]
+    assert run_stages(stages, {}, max_workers=2) == {'a': True, 'b': True}
+
+
+def test_failure_is_raised_with_the_stage_name():
+    def fail(state):
+        raise ValueError('boom')
+
+    stages = [stage('bad', fail, outputs=['x']), stage('after', lambda state: {}, inputs=['x'])]
+    with pytest.raises(RuntimeError, match='Error in stage bad: boom') as error:
+        run_stages(stages, {})
+    assert isinstance(error.value.__cause__, ValueError)
+
+
+def test_missing_outputs_are_an_error():
+    stages = [stage('lazy', lambda state: {}, outputs=['x'])]
+    with pytest.raises(RuntimeError, match='Stage lazy did not produce: x'):
+        run_stages(stages, {})
+
+
+def test_failure_cancels_queued_stages_without_waiting():
+    started = []
+    release = threading.Event()
+
+    def slow(state):
+        release.wait(5)
+        return {}
+
+    def fail(state):
+        time.sleep(0.05)
+        raise ValueError('boom')
+
+    def queued(name):
+        def run(state):
+            started.append(name)
+            return slow(state)
+        return run
+
+    # Only two workers: 'slow' and 'bad' take them, the others have to queue
+    stages = [stage('slow', slow), stage('bad', fail)] + [stage(f'q{n}', queued(f'q{n}')) for n in range(4)]
+    start = time.monotonic()
+    with pytest.raises(RuntimeError):
+        run_stages(stages, {}, max_workers=2)
+    assert time.monotonic() - start < 2
+    release.set()
+    time.sleep(0.1)
+    # At most one queued stage can grab the worker 'bad' freed before the pool was shut down
+    assert len(started) <= 1
@@ -0,0 +1,97 @@
+import threading
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+import s3_utils
+from s3_utils import get_s3_client, is_transient_error, upload_object_to_s3, upload_batch_to_s3
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'PutObject')
+
+
+class FakeS3:
+    """Records uploads, failing each key with the errors planned for it first."""
+
+    def __init__(self, failures=None):
+        self.failures = {key: list(errors) for key, errors in (failures or {}).items()}
+        self.objects = {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def upload_fileobj(self, fileobj, bucket, key, Config=None):
+        with self.lock:
+            self.calls.append(key)
+            if self.failures.get(key):
+                raise self.failures[key].pop(0)
+            self.objects[(bucket, key)] = fileobj.read()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(s3_utils.time, 'sleep', lambda seconds: None)
+
+
+@pytest.mark.parametrize('error, transient', [
+    (client_error('SlowDown'), True),
+    (client_error('503'), True),
+    (client_error('AccessDenied'), False),
+    (EndpointConnectionError(endpoint_url='https://s3'), True),
+    (ValueError('bug'), False),
+])
+def test_is_transient_error(error, transient):
+    assert is_transient_error(error) == transient
+
+
+def test_client_leaves_retries_to_the_upload_loop():
+    # Otherwise every attempt of upload_object_to_s3 would be retried again by botocore
+    assert get_s3_client().meta.config.retries['total_max_attempts'] == 1
+
+
+def test_uploads_from_memory_and_disk(tmp_path):
+    path = tmp_path / 'audio.m4a'
+    path.write_bytes(b'audio')
+    s3 = FakeS3()
+    memory = upload_object_to_s3(s3, {'bucket': 'b', 'key': 'image', 'data': b'image'})
+    disk = upload_object_to_s3(s3, {'bucket': 'b', 'key': 'audio', 'data': None, 'path': str(path)})
+    assert s3.objects == {('b', 'image'): b'image', ('b', 'audio'): b'audio'}
+    assert (memory['bytes'], memory['attempts']) == (5, 1)
+    assert (disk['bytes'], disk['attempts']) == (5, 1)
+
+
+def test_transient_failures_are_retried():
+    s3 = FakeS3({'k': [client_error('SlowDown'), client_error('InternalError')]})
+    timing = upload_object_to_s3(s3, {'bucket': 'b', 'key': 'k', 'data': b'x'}, retries=3)
+    assert timing['attempts'] == 3
+    assert s3.objects == {('b', 'k'): b'x'}
+
+
+def test_retries_are_bounded():
+    s3 = FakeS3({'k': [client_error('SlowDown')] * 5})
+    with pytest.raises(ClientError):
+        upload_object_to_s3(s3, {'bucket': 'b', 'key': 'k', 'data': b'x'}, retries=2)
+    assert s3.calls == ['k'] * 3
+
+
+def test_permanent_failures_are_not_retried():
+    s3 = FakeS3({'k': [client_error('AccessDenied')]})
+    with pytest.raises(ClientError):
+        upload_object_to_s3(s3, {'bucket': 'b', 'key': 'k', 'data': b'x'})
+    assert s3.calls == ['k']
+
+
+def test_batch_keeps_the_order_of_uploads():
+    s3 = FakeS3({'k1': [client_error('SlowDown')]})
+    uploads = [{'bucket': 'b', 'key': f'k{n}', 'data': bytes(n)} for n in range(5)]
+    timings = upload_batch_to_s3(s3, uploads, max_workers=3)
+    assert [timing['key'] for timing in timings] == [f'k{n}' for n in range(5)]
+    assert [timing['bytes'] for timing in timings] == list(range(5))
+    assert len(s3.objects) == 5
+
+
+def test_batch_failures_are_aggregated_after_the_other_uploads():
+    s3 = FakeS3({'k1': [client_error('AccessDenied')], 'k3': [ValueError('bad data')]})
+    uploads = [{'bucket': 'b', 'key': f'k{n}', 'data': b'x'} for n in range(5)]
+    with pytest.raises(RuntimeError, match='Failed to upload 2 of 5 objects') as error:
+        upload_batch_to_s3(s3, uploads, max_workers=2)
+    assert 'k1: ' in str(error.value) and 'k3: bad data' in str(error.value)
+    assert sorted(key for _, key in s3.objects) == ['k0', 'k2', 'k4']
@@ -0,0 +1,107 @@
+import os
+import types
+import pytest
+import elevenlabs_utils
+from elevenlabs_utils import text_to_speech, get_cached_speech, put_cached_speech
+
+VOICE = {'voice_id': 'v1', 'name': 'Rachel', 'model': 'Eleven Multi v2 - 50% stab - 75% sim'}
+
+
+class FakeElevenLabs:
+    """Streams 4000 bytes of 'speech' per conversion, i.e. one second of 32 kbps MP3."""
+
+    def __init__(self):
+        self.requests = []
+        self.text_to_speech = types.SimpleNamespace(convert=self.convert)
+
+    def convert(self, **kwargs):
+        self.requests.append(kwargs)
+        return iter([b'\xff' * 1000] * 4)
+
+
+@pytest.fixture(autouse=True)
+def speech_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(elevenlabs_utils, 'TTS_CACHE_DIR', f'{tmp_path}/tts-cache/')
+    monkeypatch.setattr(elevenlabs_utils, 'TTS_OUTPUT_FORMAT', 'mp3_22050_32')
+    monkeypatch.setattr(elevenlabs_utils, 'TTS_STREAM_TO', 'disk')
+    monkeypatch.setattr(elevenlabs_utils, 'tts_cache_stats', {'hits': 0, 'misses': 0})
+    return f'{tmp_path}/tts-cache/'
+
+
+def job_dir(tmp_path, name):
+    path = tmp_path / name
+    path.mkdir()
+    return str(path)
+
+
+def test_repeated_narration_is_served_from_the_cache(tmp_path):
+    client = FakeElevenLabs()
+    generated = text_to_speech(client, job_dir(tmp_path, 'job1'), dict(VOICE), 'Hello there')
+    cached = text_to_speech(client, job_dir(tmp_path, 'job2'), dict(VOICE), 'Hello there')
+    assert len(client.requests) == 1
+    assert cached == generated == {'filename': 'Rachel_narration.mp3', 'duration': 1.0}
+    with open(tmp_path / 'job2' / 'Rachel_narration.mp3', 'rb') as file:
+        assert file.read() == b'\xff' * 4000
+    assert elevenlabs_utils.tts_cache_stats == {'hits': 1, 'misses': 1}
+
+
+@pytest.mark.parametrize('change', [
+    {'script': 'Hello again'},
+    {'voice': dict(VOICE, voice_id='v2')},
+    {'voice': dict(VOICE, model='Eleven Multi v2 - 60% stab - 75% sim')},
+])
+def test_changes_to_the_request_miss_the_cache(tmp_path, change):
+    client = FakeElevenLabs()
+    text_to_speech(client, job_dir(tmp_path, 'job1'), dict(VOICE), 'Hello there')
+    text_to_speech(client, job_dir(tmp_path, 'job2'), change.get('voice', dict(VOICE)),
+                   change.get('script', 'Hello there'))
+    assert len(client.requests) == 2
+
+
+def test_cache_write_failure_keeps_the_narration(tmp_path, speech_cache):
+    # A file where the cache directory should be makes every cache write fail
+    with open(speech_cache.rstrip('/'), 'w'):
+        pass
+    client = FakeElevenLabs()
+    clip = text_to_speech(client, job_dir(tmp_path, 'job'), dict(VOICE), 'Hello there')
+    assert clip == {'filename': 'Rachel_narration.mp3', 'duration': 1.0}
+    assert os.path.getsize(tmp_path / 'job' / 'Rachel_narration.mp3') == 4000
+
+
+def test_least_recently_used_speech_is_evicted(tmp_path, speech_cache, monkeypatch):
+    monkeypatch.setattr(elevenlabs_utils, 'TTS_CACHE_MAX_BYTES', 3000)
+    directory = job_dir(tmp_path, 'job')
+
+    def put(key):
+        with open(f'{directory}/{key}.mp3', 'wb') as file:
+            file.write(b'\xff' * 1000)
+        put_cached_speech(key, directory, {'filename': f'{key}.mp3', 'duration': 0.25})
+
+    for key in ('used', 'old', 'new'):
+        put(key)
+    # Entries are ordered by their mtime, which a cache hit refreshes: 'used' was added first but read last
+    for key, mtime in (('old', 1000), ('new', 1001), ('used', 1002)):
+        os.utime(f'{speech_cache}{key}.mp3', (mtime, mtime))
+    put('extra')
+    assert sorted(os.listdir(speech_cache)) == ['extra.mp3', 'new.mp3', 'used.mp3']
+
+
+def test_hit_survives_a_concurrent_eviction(tmp_path, speech_cache, monkeypatch):
+    os.makedirs(speech_cache)
+    with open(f'{speech_cache}key.mp3', 'wb') as file:
+        file.write(b'\xff' * 4000)
+    link_file = elevenlabs_utils.link_file
+
+    def link_then_evict(source, destination):
+        link_file(source, destination)
+        os.remove(source)
+
+    monkeypatch.setattr(elevenlabs_utils, 'link_file', link_then_evict)
+    directory = job_dir(tmp_path, 'job')
+    assert get_cached_speech('key', directory, 'narration') == {'filename': 'narration.mp3', 'duration': 1.0}
+    assert os.path.getsize(f'{directory}/narration.mp3') == 4000
+
+
+def test_missing_speech_is_a_miss(tmp_path):
+    assert get_cached_speech('nope', job_dir(tmp_path, 'job'), 'narration') is None
+    assert elevenlabs_utils.tts_cache_stats == {'hits': 0, 'misses': 1}
@@ -0,0 +1,78 @@
+import sys
+import types
+import pytest
+from config_utils import parse_voice, index_voices
+from voice_utils import get_wanted_values, rank_voices, select_voice
+
+HEADERS = ['name', 'speed', 'model', 'id', 'gender', 'age', 'tone', 'use', 'attributes', 'accent']
+VOICES = tuple(parse_voice(HEADERS, line) for line in [
+    "Calm\t150\tm\t1\tF\tmid\tcalm\tstory\tsmooth, soft\tAmerican",
+    "Energy\t170\tm\t2\tM\tyoung\tenergetic, friendly\tstory\thigh expression\tAmerican",
+    "News\t160\tm\t3\tM\tmid\tpro\tfactual\tclean\tBritish",
+    "Energy Too\t165\tm\t4\tF\tyoung\tenergetic\tcharacter\tstrong\tAmerican",
+])
+INDEX = index_voices(VOICES)
+
+
+def test_wanted_values_come_from_mood_words_and_topic():
+    wanted = get_wanted_values('relaxed-soothing', 'A meditation retreat')
+    assert wanted['tone'] == {'calm': 3}
+    assert wanted['attributes'] == {'smooth': 3, 'soft': 2}
+
+
+def test_topic_terms_match_whole_words_and_plurals():
+    assert get_wanted_values('', 'Our new products')['use'] == {'factual': 1}
+    assert get_wanted_values('', 'productivity tips') == {}
+
+
+def test_ranking_is_best_first_and_stable():
+    ranking = rank_voices(VOICES, 'relaxed', 'nature walk', INDEX)
+    assert [voice['name'] for score, voice in ranking][0] == 'Calm'
+    # Ties keep their catalog order
+    tied = [voice['name'] for score, voice in ranking if score == 0]
+    assert tied == ['Energy', 'News', 'Energy Too']
+
+
+def test_select_voice_picks_the_best_match():
+    assert select_voice(None, 'professional', 'business update', VOICES, INDEX)['name'] == 'News'
+
+
+def test_local_tiebreak_is_deterministic():
+    picks = {select_voice(None, 'energetic', 'sports', VOICES, INDEX)['name'] for _ in range(5)}
+    assert len(picks) == 1
+
+
+def test_empty_catalog_is_an_error():
+    with pytest.raises(ValueError, match='empty'):
+        select_voice(None, 'calm', '', (), index_voices(()))
+
+
+@pytest.fixture
+def model_choice(monkeypatch):
+    """Stands in for the model's tiebreak, recording the candidates it was given."""
+    calls = []
+
+    def get_matching_voice(client, mood, candidates, topic):
+        calls.append([voice['name'] for voice in candidates])
+        return candidates[-1]
+
+    monkeypatch.setitem(sys.modules, 'text_to_text', types.SimpleNamespace(get_matching_voice=get_matching_voice))
+    return calls
+
+
+def test_model_breaks_ties_when_configured(model_choice):
+    voice = select_voice(object(), 'energetic', '', VOICES, INDEX, tiebreaker='llm')
+    assert model_choice == [['Energy', 'Energy Too']]
+    assert voice['name'] == 'Energy Too'
+
+
+def test_model_chooses_when_nothing_matches(model_choice, capsys):
+    voice = select_voice(object(), 'ai', 'quarterly numbers', VOICES, INDEX, tiebreaker='none')
+    assert model_choice == [['Calm', 'Energy', 'News', 'Energy Too']]
+    assert voice['name'] == 'Energy Too'
+    assert 'No voice matches' in capsys.readouterr().out
+
+
+def test_unique_best_match_skips_the_model(model_choice):
+    select_voice(object(), 'professional', '', VOICES, INDEX, tiebreaker='llm')
+    assert model_choice == []
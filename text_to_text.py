@@ -8,7 +8,10 @@ config = get_config()
 
 
 def get_text_to_text_client():
-    return openai_utils.get_openai_client()
+    if config['text-to-text'] == 'openai':
+        return openai_utils.get_openai_client()
+    else:
+        raise ValueError(f"Invalid text-to-text value: {config['text-to-text']}")
 
 
 def describe_and_recommend(*args, **kwargs):
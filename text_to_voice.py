@@ -11,7 +11,10 @@ config = get_config()
 
 
 def get_text_to_voice_client():
-    return elevenlabs_utils.get_elevenlabs_client()
+    if config['text-to-voice'] == 'elevenlabs':
+        return elevenlabs_utils.get_elevenlabs_client()
+    else:
+        raise ValueError(f"Invalid text-to-voice value: {config['text-to-voice']}")
 
 
 def get_voice_tone_data():
@@ -0,0 +1,144 @@
+import re
+import zlib
+from config_utils import get_config
+
+config = get_config()
+# When several voices share the best score, the tie can be broken by the text-to-text model ('llm') or locally
+# ('none').  The local tiebreak is deterministic for a given mood and topic.
+VOICE_TIEBREAKER = config.get('voice-tiebreaker', 'none')
+
+# How much a match on each catalog column counts towards a voice's score
+FIELD_WEIGHTS = {'tone': 3, 'use': 2, 'attributes': 1, 'age': 1, 'gender': 1, 'accent': 1}
+
+# The moods offered by the UI (e.g. 'energetic-positive') are split into words, each calling for these values
+MOOD_TERMS = {
+    'energetic': {'tone': ['energetic']},
+    'positive': {'tone': ['friendly', 'energetic']},
+    'relaxed': {'tone': ['calm'], 'attributes': ['smooth']},
+    'soothing': {'tone': ['calm'], 'attributes': ['smooth', 'soft']},
+    'uplifting': {'tone': ['energetic', 'friendly'], 'attributes': ['high expression']},
+    'motivational': {'tone': ['energetic', 'intense'], 'attributes': ['commanding']},
+    'inspirational': {'tone': ['energetic', 'intense'], 'attributes': ['high expression']},
+    'professional': {'tone': ['pro'], 'use': ['factual'], 'attributes': ['clean']},
+    'polished': {'tone': ['pro'], 'attributes': ['clean', 'smooth']},
+    'intense': {'tone': ['intense'], 'use': ['dramatic']},
+    'powerful': {'tone': ['intense'], 'attributes': ['strong', 'commanding', 'deep']},
+    'relatable': {'tone': ['friendly'], 'use': ['story']},
+    'casual': {'tone': ['friendly'], 'use': ['story']},
+    'calm': {'tone': ['calm']},
+    'friendly': {'tone': ['friendly']},
+}
+
+# Words in the topic that hint at a style of narration
+TOPIC_TERMS = {
+    'story': {'use': ['story']},
+    'family': {'tone': ['friendly'], 'use': ['story']},
+    'kids': {'tone': ['friendly'], 'use': ['story']},
+    'children': {'tone': ['friendly'], 'use': ['story']},
+    'birthday': {'tone': ['friendly', 'energetic']},
+    'wedding': {'tone': ['calm', 'friendly'], 'attributes': ['smooth']},
+    'vacation': {'tone': ['friendly', 'energetic'], 'use': ['story']},
+    'travel': {'tone': ['friendly'], 'use': ['story']},
+    'nature': {'tone': ['calm'], 'attributes': ['smooth']},
+    'meditation': {'tone': ['calm'], 'attributes': ['soft', 'smooth']},
+    'memorial': {'tone': ['calm'], 'attributes': ['soft', 'deep']},
+    'news': {'tone': ['pro'], 'use': ['factual']},
+    'business': {'tone': ['pro'], 'use': ['factual']},
+    'product': {'tone': ['pro'], 'use': ['factual']},
+    'real estate': {'tone': ['pro'], 'use': ['factual'], 'attributes': ['smooth']},
+    'tutorial': {'tone': ['pro'], 'use': ['factual'], 'attributes': ['clean']},
+    'history': {'use': ['factual', 'dramatic'], 'attributes': ['deep']},
+    'sports': {'tone': ['energetic', 'intense'], 'use': ['dramatic']},
+    'game': {'tone': ['energetic'], 'use': ['character']},
+    'action': {'tone': ['intense'], 'use': ['dramatic']},
+    'adventure': {'tone': ['energetic'], 'use': ['dramatic', 'story']},
+    'horror': {'tone': ['intense'], 'use': ['dramatic', 'character'], 'attributes': ['deep']},
+}
+
+
+def get_wanted_values(mood, topic):
+    """
+    Translates the requested mood and topic into the catalog values they call for.
+
+    Args:
+        mood (str): The requested mood, e.g. 'relaxed-soothing' (or 'ai' to let the topic decide).
+        topic (str): The topic of the video.
+
+    Returns:
+        dict: The wanted values per column, with how many times each one was asked for.
+    """
+    wanted = {}
+
+    def want(terms):
+        for field, values in terms.items():
+            for value in values:
+                wanted.setdefault(field, {})
+                wanted[field][value] = wanted[field].get(value, 0) + 1
+
+    for word in re.split(r'[^a-z]+', (mood or '').lower()):
+        want(MOOD_TERMS.get(word, {}))
+    topic = ' '.join(re.split(r'[^a-z]+', (topic or '').lower()))
+    for term, terms in TOPIC_TERMS.items():
+        if re.search(rf'\b{term}s?\b', topic):
+            want(terms)
+    return wanted
+
+
+def rank_voices(voices, mood, topic, index):
+    """
+    Scores every voice of the catalog against the requested mood and topic.
+
+    Args:
+        voices (tuple): The voices (see `config_utils.get_voice_catalog`).
+        mood (str): The requested mood.
+        topic (str): The topic of the video.
+        index (dict): The index of `voices`.
+
+    Returns:
+        list: (score, voice) pairs, best first.  Voices with the same score keep their catalog order.
+    """
+    scores = [0] * len(voices)
+    for field, values in get_wanted_values(mood, topic).items():
+        for value, count in values.items():
+            for position in index[field].get(value, ()):
+                scores[position] += FIELD_WEIGHTS[field] * count
+    order = sorted(range(len(voices)), key=lambda position: -scores[position])
+    return [(scores[position], voices[position]) for position in order]
+
+
+def select_voice(client, mood, topic, voices, index, tiebreaker=VOICE_TIEBREAKER):
+    """
+    Selects the voice that best matches the requested mood and topic.
+
+    Args:
+        client (object): The text-to-text client, only used when the tie is broken by the model.
+        mood (str): The requested mood.
+        topic (str): The topic of the video.
+        voices (tuple): The voices (see `config_utils.get_voice_catalog`).
+        index (dict): The index of `voices`.
+        tiebreaker (str): 'llm' to let the model choose among the best voices, 'none' to choose locally.  When no
+            voice matches at all (e.g. for the 'ai' mood), the model chooses whenever a client is given.
+
+    Returns:
+        dict: The selected voice.
+
+    Raises:
+        ValueError: If there are no voices to choose from.
+    """
+    if not voices:
+        raise ValueError("The voice catalog is empty")
+    ranking = rank_voices(voices, mood, topic, index)
+    best_score = ranking[0][0]
+    candidates = [voice for score, voice in ranking if score == best_score]
+    if best_score == 0:
+        print(f"No voice matches mood '{mood}' and topic '{topic}', choosing among all {len(candidates)} voices")
+    else:
+        print(f"Voice candidates (score {best_score}): {', '.join(voice['name'] for voice in candidates)}")
+    if len(candidates) > 1 and (tiebreaker == 'llm' or best_score == 0) and client is not None:
+        from text_to_text import get_matching_voice
+        try:
+            return get_matching_voice(client, mood, candidates, topic)
+        except Exception as e:
+            print(f"Voice tiebreak failed, choosing locally: {e}")
+    # Spread the choice over the tied voices, but always give the same answer for the same request
+    return candidates[zlib.crc32(f"{mood}\0{topic}".encode()) % len(candidates)]